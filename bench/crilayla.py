@@ -0,0 +1,99 @@
+"""
+Decoding throughput of `lib.cri.crilayla` across payload sizes.
+
+Run from the repository root with `python -m bench.crilayla`. Payloads are
+synthesized directly as CRILAYLA bitstreams (a mix of literals and overlapping
+and non-overlapping back-references), so the benchmark does not depend on an
+encoder. A linear decoder shows a flat time per MiB across the whole range.
+"""
+
+from argparse import ArgumentParser
+from io import BytesIO
+import random
+import time
+
+from lib.cri.crilayla import decode
+
+
+def main() -> None:
+    parser = ArgumentParser()
+    parser.add_argument("--min-size", type=int, default=64 << 10)
+    parser.add_argument("--max-size", type=int, default=64 << 20)
+    parser.add_argument("--repeat", type=int, default=3)
+    args = parser.parse_args()
+
+    print(f"{'size':>12} {'encoded':>12} {'best (s)':>10} {'s/MiB':>8}")
+    size = args.min_size
+    while size <= args.max_size:
+        payload = _synthesize(size, random.Random(size))
+        best = float("inf")
+        for _ in range(args.repeat):
+            start = time.perf_counter()
+            decode(BytesIO(payload))
+            best = min(best, time.perf_counter() - start)
+        print(f"{size:>12} {len(payload):>12} {best:>10.3f} {best / (size / (1 << 20)):>8.3f}")
+        size *= 4
+
+
+def _synthesize(size: int, rng: random.Random) -> bytes:
+    writer = _BitWriter()
+    written = 0
+    while written < size:
+        remaining = size - written
+        if written < 3 or remaining < 3 or rng.random() < 0.4:
+            writer.write(1, 0)
+            writer.write(8, rng.randrange(256))
+            written += 1
+            continue
+        offset = rng.randrange(3, min(written, 0x1FFF + 3) + 1)
+        length = min(rng.choice((3, 4, 8, 16, 40, 300)), remaining)
+        writer.write(1, 1)
+        writer.write(13, offset - 3)
+        rest = length - 3
+        for chunk_length in (2, 3, 5):
+            chunk_mask = (1 << chunk_length) - 1
+            writer.write(chunk_length, min(rest, chunk_mask))
+            if rest < chunk_mask:
+                break
+            rest -= chunk_mask
+        else:
+            while True:
+                writer.write(8, min(rest, 0xFF))
+                if rest < 0xFF:
+                    break
+                rest -= 0xFF
+        written += length
+    encoded = writer.getvalue()
+    return (
+        b"CRILAYLA"
+        + size.to_bytes(4, "little")
+        + len(encoded).to_bytes(4, "little")
+        + encoded
+        + bytes(256)
+    )
+
+
+class _BitWriter:
+    def __init__(self) -> None:
+        self._buffer = bytearray()
+        self._bits = 0
+        self._count = 0
+
+    def write(self, count: int, value: int) -> None:
+        self._bits = (self._bits << count) | value
+        self._count += count
+        while self._count >= 8:
+            self._count -= 8
+            self._buffer.append((self._bits >> self._count) & 0xFF)
+        self._bits &= (1 << self._count) - 1
+
+    def getvalue(self) -> bytes:
+        buffer = bytearray(self._buffer)
+        if self._count:
+            buffer.append((self._bits << (8 - self._count)) & 0xFF)
+        buffer.reverse()
+        return bytes(buffer)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,53 @@
+"""
+Throughput of the CPK table cipher in `lib.cri.cpk._common`.
+
+Run from the repository root with `python -m bench.crypt`. Each size is
+measured for `crypt()` and for the byte-at-a-time loop it replaced, and the
+two outputs are checked against each other.
+"""
+
+from argparse import ArgumentParser
+import os
+import time
+
+from lib.cri.cpk._common import crypt
+
+
+def main() -> None:
+    parser = ArgumentParser()
+    parser.add_argument("--max-size", type=int, default=16 << 20)
+    parser.add_argument("--repeat", type=int, default=5)
+    args = parser.parse_args()
+
+    print(f"{'size':>10} {'crypt (s)':>10} {'loop (s)':>10} {'speedup':>8}")
+    size = 1 << 10
+    while size <= args.max_size:
+        data = os.urandom(size)
+        if crypt(data) != _reference_crypt(data):
+            raise AssertionError(f"mismatch at size {size}")
+        fast = _measure(crypt, data, args.repeat)
+        slow = _measure(_reference_crypt, data, 1 if size > (1 << 20) else args.repeat)
+        print(f"{size:>10} {fast:>10.5f} {slow:>10.5f} {slow / fast:>7.0f}x")
+        size *= 4
+
+
+def _measure(function, data: bytes, repeat: int) -> float:
+    best = float("inf")
+    for _ in range(repeat):
+        start = time.perf_counter()
+        function(data)
+        best = min(best, time.perf_counter() - start)
+    return best
+
+
+def _reference_crypt(data: bytes) -> bytes:
+    buffer = bytearray(data)
+    key = 0x5F
+    for i in range(len(data)):
+        buffer[i] ^= key
+        key = (key * 0x15) & 0xFF
+    return bytes(buffer)
+
+
+if __name__ == "__main__":
+    main()
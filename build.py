@@ -1,29 +1,34 @@
 import glob
+import os
 import shutil
 import sys
 
+from dataclasses import replace
 from pathlib import Path
 from argparse import Namespace, ArgumentError
 
 from typing import Any
 
-from config import RESOURCES_PATH
+from config import RESOURCES_PATH, MGSSCRIPTTOOLS_PATH, PATCHSCS_PATH, UNGELIFY_PATH, BANK_PATH
 
-from lib.ScriptPatcher import ScriptPatcher
+from lib.ScriptPatcher import PatchCache, ScriptPatcher
 from lib.TranslationProcessor import TranslationProcessor
+from lib.manifest import BuildManifest, digest_values
 from lib.utils import (
+	clean_tree,
 	load_text,
 	get_custom_cls_loader,
 	load_yaml,
 	get_archive_unpacker,
+	is_partially_unpacked,
 	get_archive_repacker,
-	compile_scripts,
+	compile_changed_scripts,
 	decompile_scripts
 )
 
 from lib.schema import YAML_SCHEMA
 from lib.args import ArgumentParserHandler
-from lib.types import BuildInfo, Language
+from lib.types import ArchiveFormat, BuildInfo, Language, ScriptFormat
 
 def main() -> None:
 	data_dir = Path("data")
@@ -66,11 +71,35 @@ def main() -> None:
 	raw_scs_dir = build_dir / "scs"
 	patch_scs_dir = build_dir / "scs-patched"
 
-	load_custom_cls = get_custom_cls_loader(data_dir / build_info.game / f"cls_{ build_info.platform }{ lang_suffix }")
-	unpack_archive = get_archive_unpacker(src_script_dir, load_custom_cls, build_info)
-	repack_archive = get_archive_repacker(src_script_dir, out_dir, load_custom_cls, build_info)
-
-	if build_info.archive: unpack_archive(src_dir, "script")
+	cls_dir = data_dir / build_info.game / f"cls_{ build_info.platform }{ lang_suffix }"
+	load_custom_cls = get_custom_cls_loader(cls_dir)
+	unpack_archive = get_archive_unpacker(src_script_dir, load_custom_cls, build_info, index_cache = build_dir / "cache" / "cpk-index")
+
+	# Each stage below only runs when the digest of its inputs differs from the one it last
+	# completed with (or its output is gone); `--clean` starts from an empty manifest.
+	manifest = BuildManifest(build_dir / "manifest.json", build_info.clean)
+	repack_archive = get_archive_repacker(src_script_dir, out_dir, load_custom_cls, build_info, build_dir / "cache" / "repack", manifest.digest_file)
+	settings = digest_values(replace(build_info, clean = False), manifest.digest_paths(data_dir / "games.yaml"))
+	# The tools are .NET applications: the executables are launchers, their code lives next to them.
+	script_tool = manifest.digest_paths(MGSSCRIPTTOOLS_PATH.parent, BANK_PATH)
+
+	# The archive readers and writers, so that a fix to either invalidates the stages using them
+	# (sources only, as bytecode caches differ between interpreters).
+	archive_code = [ Path("lib") / "utils.py", *sorted((Path("lib") / "cri").rglob("*.py")) ]
+
+	source_archives = [ src_script_dir / f"script{ build_info.archive }" ] if build_info.archive else []
+	source_archives += [ src_script_dir / f"mes{+lang:02}.cpk" for lang in build_info.langs ]
+
+	scripts_key : str
+	if build_info.archive:
+		scripts_key = manifest.key("unpack", settings, manifest.digest_paths(*source_archives, cls_dir, UNGELIFY_PATH, *archive_code))
+		# Every later stage needs all of the scripts, so a filtered extraction never counts as this stage's output.
+		if not manifest.is_current("unpack", scripts_key, src_dir) or is_partially_unpacked(src_dir):
+			clean_tree(str(src_dir))
+			unpack_archive(src_dir, "script")
+			manifest.record("unpack", scripts_key)
+	else:
+		scripts_key = manifest.digest_paths(src_script_dir / "script")
 
 	constants : dict[str, str] = load_yaml(data_dir / build_info.game / "consts.yaml") or dict()
 
@@ -78,20 +107,79 @@ def main() -> None:
 		for index, name in load_custom_cls(arc_name).items():
 			constants[name.split(".", 1)[0]] = str(index)
 
-	if not raw_scs_dir.exists() or build_info.clean:
-		decompile_scripts(raw_scs_dir, src_dir if build_info.archive else src_script_dir / "script", build_info.flag_set, build_info.charset, build_info.string_unit_encoding)
+	decompile_key = manifest.key("decompile", settings, script_tool, scripts_key)
+	if not manifest.is_current("decompile", decompile_key, raw_scs_dir):
+		clean_tree(str(raw_scs_dir))
+		decompile_scripts(raw_scs_dir, src_dir if build_info.archive else src_script_dir / "script", build_info.flag_set, build_info.charset, build_info.string_unit_encoding, os.cpu_count() or 1)
+
+		if build_info.game == "chaos_head" and build_info.selected != Language.JAPANESE:
+			with open(raw_scs_dir / "schzdoz_223.scs", "w", encoding="utf-8") as f:
+				f.write("0:\n")
+			with open(raw_scs_dir / "schzdoz_223.sct", "w", encoding="utf-8") as f:
+				pass
+			with open(raw_scs_dir / "mes01" / "schzdoz_223_01.mst", "w", encoding="utf-8") as f:
+				f.write("0:\n")
 
-	if build_info.game == "chaos_head" and build_info.selected != Language.JAPANESE:
-		with open(raw_scs_dir / "schzdoz_223.scs", "w", encoding="utf-8") as f:
-			f.write("0:\n")
-		with open(raw_scs_dir / "schzdoz_223.sct", "w", encoding="utf-8") as f:
-			pass
-		with open(raw_scs_dir / "mes01" / "schzdoz_223_01.mst", "w", encoding="utf-8") as f:
-			f.write("0:\n")
+		manifest.record("decompile", decompile_key)
 
+	# Patches and translations are applied in place to the same copy of the scripts, so they make up a single stage.
+	txt_dirs = [ data_dir / build_info.game / f"txt_{ lang }" for lang in build_info.langs ]
+	if build_info.selected != "all":
+		txt_dirs.append(data_dir / build_info.game / f"txt_{ build_info.selected }")
+	patch_tool = manifest.digest_paths(PATCHSCS_PATH.parent)
+	patch_key = manifest.key("patch", settings, decompile_key, patch_tool, manifest.digest_paths(
+		Path("lib") / "ScriptPatcher.py",
+		Path("lib") / "TranslationProcessor.py",
+		data_dir / build_info.game / "consts.yaml",
+		cls_dir,
+		data_dir / build_info.game / "patches_common",
+		data_dir / build_info.game / f"patches_{ build_info.platform }{ lang_suffix }",
+		*txt_dirs,
+	))
+	if not manifest.is_current("patch", patch_key, patch_scs_dir):
+		patch_cache = PatchCache(build_dir / "cache" / "patched-scs", patch_tool, manifest.digest_file, build_info.clean)
+		apply_patches(data_dir, build_info, lang_suffix, build_dir, raw_scs_dir, patch_scs_dir, constants, patch_cache)
+		patch_cache.prune()
+		manifest.record("patch", patch_key)
+
+	compile_key = manifest.key("compile", settings, script_tool, patch_key)
+	if not manifest.is_current("compile", compile_key, dst_dir):
+		if build_info.clean: clean_tree(str(dst_dir))
+		compile_changed_scripts(dst_dir, patch_scs_dir, build_dir / "compiled.json", digest_values(settings, script_tool), manifest.digest_file, build_info.flag_set, build_info.charset, build_info.string_unit_encoding, os.cpu_count() or 1)
+
+		# For case-sensitive filesystems
+		if build_info.archive:
+			sought_extension = Path(load_custom_cls("script")[0]).suffix
+			if not str.islower(sought_extension):
+				for fl in glob.glob(f"*{ sought_extension.lower() }", root_dir=dst_dir, recursive=False):
+					shutil.move(dst_dir / fl, dst_dir / fl.replace(sought_extension.lower(), sought_extension))
+
+		manifest.record("compile", compile_key)
+
+	repack_key = manifest.key("repack", settings, compile_key, manifest.digest_paths(*source_archives, cls_dir, UNGELIFY_PATH, *archive_code))
+	repacked : list[Path]
+	match build_info.archive:
+		case ArchiveFormat.MPK:
+			repacked = [ out_dir / "enscript.mpk" ]
+		case ArchiveFormat.CPK:
+			repacked = [ out_dir / "c0script.cpk" ]
+			if build_info.in_fmt == ScriptFormat.MST:
+				repacked += [ out_dir / f"mes{+lang:02}.cpk" for lang in build_info.langs ]
+		case None:
+			repacked = [ out_dir ]
+	if not manifest.is_current("repack", repack_key, *repacked):
+		out_dir.mkdir(parents=True, exist_ok=True)
+
+		if not build_info.archive: shutil.copytree(dst_dir, out_dir, dirs_exist_ok=True)
+		else: repack_archive("script", dst_dir)
+
+		manifest.record("repack", repack_key)
+
+def apply_patches(data_dir: Path, build_info: BuildInfo, lang_suffix: str, build_dir: Path, raw_scs_dir: Path, patch_scs_dir: Path, constants: dict[str, str], patch_cache: PatchCache) -> None:
+	clean_tree(str(patch_scs_dir))
 	shutil.copytree(raw_scs_dir, patch_scs_dir, dirs_exist_ok=True)
 			
-	patcher = ScriptPatcher(patch_scs_dir, build_dir, constants, build_info)
+	patcher = ScriptPatcher(patch_scs_dir, build_dir, constants, build_info, patch_cache)
 	
 	def load_patches(root: Path) -> None:
 		for name in glob.glob("**/*.patch", root_dir=root, recursive=True):
@@ -117,7 +205,8 @@ def main() -> None:
 
 			lang_patcher = ScriptPatcher(
 				patch_scs_dir, build_dir,
-				constants, build_info.with_language(lang)
+				constants, build_info.with_language(lang),
+				patch_cache
 			)
 
 			TranslationProcessor(lang_patcher, "10_translation/", txt_dir).run()
@@ -132,19 +221,5 @@ def main() -> None:
 
 			shutil.copyfile(txt_dir / raw,  patch_scs_dir / dst, follow_symlinks=True)
 
-	compile_scripts(dst_dir, patch_scs_dir, build_info.flag_set, build_info.charset, build_info.string_unit_encoding)
-
-	out_dir.mkdir(parents=True, exist_ok=True)
-
-	if not build_info.archive: shutil.copytree(dst_dir, out_dir, dirs_exist_ok=True)
-	else:
-		# For case-sensitive filesystems
-		sought_extension = Path(load_custom_cls("script")[0]).suffix
-		if not str.islower(sought_extension):
-			for fl in glob.glob(f"*{ sought_extension.lower() }", root_dir=dst_dir, recursive=False):
-				shutil.move(dst_dir / fl, dst_dir / fl.replace(sought_extension.lower(), sought_extension))
-		
-		repack_archive("script", dst_dir)
-
 if __name__ == "__main__":
 	main()
\ No newline at end of file
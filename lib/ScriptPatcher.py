@@ -1,22 +1,60 @@
 # TODO: Documentation
 # TODO: Patching overhaul
 
+import asyncio
 from pathlib import Path
+import os
 import re
+import shutil
+import tempfile
 from typing import Optional, Callable, Self, assert_never
 
 from config import (
 	PATCHSCS_PATH,
 )
-from lib.utils import load_mst, save_mst, run_command
+from lib.manifest import digest_values
+from lib.utils import load_mst, save_mst, run_commands
 from lib.types import ScriptFormat, BuildInfo, SaveMethod
 
+class PatchCache:
+	# Patching is deterministic, so patched scripts are kept by the digest of the script before
+	# patching, its hunks (constants already substituted) and PatchScs itself. Entries that no
+	# patcher of the current build used are removed by `prune` once all of them ran.
+	def __init__(self : Self, cache_dir: Path, tool_digest: str, digest_file: Callable[[Path], str], clean: bool):
+		self.cache_dir   : Path = cache_dir
+		self.tool_digest : str = tool_digest
+		self.digest_file : Callable[[Path], str] = digest_file
+		self.clean       : bool = clean
+		self.used        : set[str] = set()
+		cache_dir.mkdir(parents=True, exist_ok=True)
+
+	def key(self : Self, script_path: Path, hunks: list[str]) -> str:
+		key = digest_values(self.tool_digest, self.digest_file(script_path), *hunks)
+		self.used.add(key)
+		return key
+
+	def restore(self : Self, key: str, script_path: Path) -> bool:
+		# `--clean` builds patch everything again, but still refresh the cache.
+		if self.clean or not (self.cache_dir / key).exists(): return False
+		shutil.copyfile(self.cache_dir / key, script_path)
+		return True
+
+	def store(self : Self, key: str, script_path: Path) -> None:
+		shutil.copyfile(script_path, self.cache_dir / f"{ key }.tmp")
+		os.replace(self.cache_dir / f"{ key }.tmp", self.cache_dir / key)
+
+	def prune(self : Self) -> None:
+		for path in self.cache_dir.iterdir():
+			if path.name not in self.used:
+				path.unlink()
+
 class ScriptPatcher:
-	def __init__(self : Self, scs_dir: Path, build_dir: Path, consts: dict[str, str], build_info : BuildInfo):
+	def __init__(self : Self, scs_dir: Path, build_dir: Path, consts: dict[str, str], build_info : BuildInfo, cache: PatchCache):
 		self.scs_dir     : Path = scs_dir
 		self.build_dir   : Path = build_dir
 		self.consts      : dict[str, str] = consts
 		self.build_info  : BuildInfo = build_info
+		self.cache       : PatchCache = cache
 		self.scs_patches : list[tuple[str, str]] = []
 		self.mst_patches : dict[str, dict[int, dict[int, str]]] = {}
 
@@ -42,15 +80,54 @@ class ScriptPatcher:
 		self._apply_mst_patches()
 
 	def _apply_scs_patches(self) -> None:
-		patch_path = self.build_dir / "combined.patch"
-		with open(patch_path, "w", encoding="utf-8") as f:
-			for (_, text) in sorted(self.scs_patches, key=lambda x: x[0]):
-				f.write(f"{text}\n\n")
-		run_command(
-			PATCHSCS_PATH,
-			self.scs_dir,
-			patch_path,
-		)
+		# Hunks are grouped by the script they target, keeping their sorted order, and each touched
+		# script is patched by its own PatchScs process (at most one per core at a time) in a staging
+		# directory holding only that script.
+		hunks = self._group_scs_hunks()
+		if not hunks: return
+
+		keys = { script: self.cache.key(self.scs_dir / script, script_hunks) for script, script_hunks in hunks.items() }
+		for script, key in keys.items():
+			if self.cache.restore(key, self.scs_dir / script):
+				del hunks[script]
+		print(f"Patching { len(hunks) } of { len(keys) } scripts")
+		if not hunks: return
+
+		with tempfile.TemporaryDirectory(prefix="patch-", dir=self.build_dir) as staging_dir:
+			staged : list[tuple[str, Path, Path]] = []
+			for index, (script, script_hunks) in enumerate(hunks.items()):
+				script_dir = Path(staging_dir) / f"{ index }"
+				(script_dir / "scs" / script).parent.mkdir(parents=True)
+				shutil.copyfile(self.scs_dir / script, script_dir / "scs" / script)
+				with open(script_dir / "script.patch", "w", encoding="utf-8") as f:
+					f.writelines(script_hunks)
+				staged.append((script, script_dir / "scs", script_dir / "script.patch"))
+
+			results = asyncio.run(run_commands([ [ PATCHSCS_PATH, scs_dir, patch_path ] for _, scs_dir, patch_path in staged ], os.cpu_count() or 1))
+
+			failures = 0
+			for (script, _, _), (returncode, output) in zip(staged, results):
+				if returncode != 0:
+					failures += 1
+					print(f"[ERROR]\tPatchScs failed on { script } (exit code { returncode })")
+				print(output.decode("utf-8", errors="replace"), end="")
+			if failures:
+				raise Exception(f"PatchScs failed on { failures } of { len(staged) } scripts")
+
+			for script, scs_dir, _ in staged:
+				self.cache.store(keys[script], scs_dir / script)
+				os.replace(scs_dir / script, self.scs_dir / script)
+
+	def _group_scs_hunks(self) -> dict[str, list[str]]:
+		# Splitting at each `@@ <script>` line; lines before a patch's first hunk (comments) stay
+		# with that hunk, and each patch still ends with a blank line, as in a single combined patch.
+		hunks : dict[str, list[str]] = {}
+		for (_, text) in sorted(self.scs_patches, key=lambda x: x[0]):
+			preamble, *parts = re.split(r"^(?=@@)", f"{text}\n\n", flags=re.MULTILINE)
+			for i, part in enumerate(parts):
+				script = part.split("\n", 1)[0][2:].strip()
+				hunks.setdefault(script, []).append(preamble + part if i == 0 else part)
+		return hunks
 
 	def _apply_mst_patches(self) -> None:
 		for script, script_table in self.mst_patches.items():
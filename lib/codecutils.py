@@ -1,4 +1,4 @@
-from typing import BinaryIO
+from typing import Any, BinaryIO
 import struct
 
 
@@ -69,3 +69,48 @@ def read_any_be_f4(fp: BinaryIO) -> None:
 
 def read_any_be_f8(fp: BinaryIO) -> None:
     return struct.unpack(">d", read_any_bytes(fp, 8))[0]
+
+
+class ByteCursor:
+    def __init__(self, data: bytes | bytearray | memoryview, position: int = 0):
+        self._view = memoryview(data)
+        self.position = position
+
+    def __len__(self) -> int:
+        return len(self._view)
+
+    def seek(self, position: int) -> None:
+        self.position = position
+
+    def unpack(self, format_: struct.Struct) -> tuple[Any, ...]:
+        position = self.position
+        if position + format_.size > len(self._view):
+            raise EOFError
+        self.position = position + format_.size
+        return format_.unpack_from(self._view, position)
+
+    def pack(self, format_: struct.Struct, *values: Any) -> None:
+        position = self.position
+        if position + format_.size > len(self._view):
+            raise EOFError
+        format_.pack_into(self._view, position, *values)
+        self.position = position + format_.size
+
+    def read_any_bytes(self, length: int) -> memoryview:
+        position = self.position
+        if position + length > len(self._view):
+            raise EOFError
+        self.position = position + length
+        return self._view[position:position + length]
+
+    def read_bytes(self, expected: bytes) -> None:
+        actual = bytes(self.read_any_bytes(len(expected)))
+        if actual != expected:
+            raise ValueError(f"expected {expected!r}, got {actual!r}")
+
+    def write_bytes(self, value: bytes | bytearray | memoryview) -> None:
+        position = self.position
+        if position + len(value) > len(self._view):
+            raise EOFError
+        self._view[position:position + len(value)] = value
+        self.position = position + len(value)
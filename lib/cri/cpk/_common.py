@@ -2,9 +2,22 @@ BODY_OFFSET = 2048
 
 
 def crypt(data: bytes) -> bytes:
-    buffer = bytearray(data)
+    # The key sequence is periodic, so XOR against a repeated keystream as a
+    # single big-integer operation instead of byte by byte.
+    size = len(data)
+    keystream = (_KEYSTREAM * (size // len(_KEYSTREAM) + 1))[:size]
+    value = int.from_bytes(data, "little") ^ int.from_bytes(keystream, "little")
+    return value.to_bytes(size, "little")
+
+
+def _keystream() -> bytes:
+    buffer = bytearray()
     key = 0x5F
-    for i in range(len(data)):
-        buffer[i] ^= key
+    while True:
+        buffer.append(key)
         key = (key * 0x15) & 0xFF
-    return bytes(buffer)
+        if key == 0x5F:
+            return bytes(buffer)
+
+
+_KEYSTREAM = _keystream()
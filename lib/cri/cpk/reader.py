@@ -1,17 +1,26 @@
 from dataclasses import dataclass
-from operator import itemgetter
-from io import BytesIO
-from typing import BinaryIO
+import fnmatch
+import hashlib
+import mmap
+import os
+from pathlib import Path
+import re
+import struct
+from threading import Lock
+from typing import Any, BinaryIO, Iterable, Iterator
+
+import numpy as np
 
 from lib.codecutils import (
+    ByteCursor,
     read_any_bytes,
-    read_any_le_u,
 )
 from lib.cri.cpk._common import crypt
-from lib.cri.crilayla import decode as decode_crilayla
+from lib.cri.crilayla import decode_buffer as decode_crilayla
 from lib.cri.utf import (
     Table,
-    decode as decode_table,
+    decode_array,
+    decode_lazy as decode_table,
 )
 
 
@@ -21,122 +30,301 @@ class Entry:
     id_: int
 
 
+@dataclass(frozen=True)
+class Range:
+    offset: int
+    encoded_size: int
+    size: int
+
+
 class Reader:
-    def __init__(self, fp: BinaryIO):
+    def __init__(
+        self, fp: BinaryIO, use_mmap: bool = False, index_cache: Path | None = None
+    ):
         self._fp = fp
-        self._read_info()
+        # Entry reads never move the shared file position (`os.pread`, or a
+        # lock around seek + read where it is unavailable), so a reader can
+        # be used from several threads at once.
+        self._lock = Lock()
+        # Mode 2 archives name their entries in the TOC. Names are only
+        # decoded on the first lookup by name.
+        self._names_lock = Lock()
+        self._names : dict[str, Entry] | None = None
+        # In mmap mode, uncompressed entries are returned as views into the
+        # mapping. They must be released before `close()` unmaps it.
+        self._map : mmap.mmap | None = None
+        self._view : memoryview | None = None
+        if use_mmap:
+            self._map = mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ)
+            self._view = memoryview(self._map)
+
+        # With an index cache directory, the decoded entry table is stored
+        # there and reused for as long as the archive's size and mtime match.
+        key = None if index_cache is None else _index_key(fp)
+        index = None if key is None else _load_index(index_cache, key)
+        if index is None:
+            index = self._read_info()
+            if key is not None:
+                _save_index(index_cache, key, index)
+        self._set_index(index)
 
     def get_by_id(self, id_: int) -> Entry:
         return self._by_id[id_]
 
-    def read_file(self, index: int) -> bytes:
+    def get_by_name(self, name: str) -> Entry:
+        return self._get_names()[name]
+
+    def glob(self, pattern: str) -> Iterator[tuple[str, Entry]]:
+        match = re.compile(fnmatch.translate(pattern)).match
+        for name, entry in self._get_names().items():
+            if match(name):
+                yield name, entry
+
+    def get_range(self, index: int) -> Range:
+        return self._ranges[index]
+
+    def read_file(self, index: int) -> bytes | memoryview:
         entry = self._ranges[index]
-        self._fp.seek(entry.offset)
-        data = read_any_bytes(self._fp, entry.encoded_size)
+        data = self.read_encoded_file(index)
         if entry.encoded_size != entry.size:
-            data = decode_crilayla(BytesIO(data))
+            data = decode_crilayla(data)
             if len(data) != entry.size:
                 raise ValueError("size mismatch")
         return data
 
-    def _read_info(self) -> None:
+    def read_encoded_file(self, index: int) -> bytes | memoryview:
+        entry = self._ranges[index]
+        return self._read_range(entry.offset, entry.encoded_size)
+
+    def close(self) -> None:
+        if self._view is not None:
+            self._view.release()
+            self._view = None
+        if self._map is not None:
+            self._map.close()
+            self._map = None
+
+    def _read_info(self) -> np.ndarray:
         header_table = self._read_table(self._fp, b"CPK ")
         [header] = header_table.rows
 
         if header["ItocSize"] == 0:
             raise NotImplementedError
 
-        staging : list[_StagingEntry] = []
+        alignment = header["Align"]
         match header["CpkMode"]:
             case 0:
                 [itoc] = self._read_span_table(
-                    header["ItocOffset"], header["ItocSize"], b"ITOC"
+                    header["ItocOffset"], header["ItocSize"], b"ITOC", _ITOC_MODE_0_COLUMNS
                 ).rows
-                itoc_l = decode_table(itoc["DataL"])
-                itoc_h = decode_table(itoc["DataH"])
+                itoc_l = decode_array(itoc["DataL"], _ITOC_DATA_COLUMNS).array
+                itoc_h = decode_array(itoc["DataH"], _ITOC_DATA_COLUMNS).array
 
-                for table in (itoc_l, itoc_h):
-                    for row in table.rows:
-                        staging.append(
-                            _StagingEntry(
-                                id_ = row["ID"],
-                                encoded_size = row["FileSize"],
-                                size = row["ExtractSize"],
-                            )
-                        )
+                ids = np.concatenate((itoc_l["ID"], itoc_h["ID"])).astype(np.int64)
+                toc_rows = np.zeros(len(ids), np.int64)
+                encoded_sizes = np.concatenate((itoc_l["FileSize"], itoc_h["FileSize"])).astype(np.int64)
+                sizes = np.concatenate((itoc_l["ExtractSize"], itoc_h["ExtractSize"])).astype(np.int64)
+                order = np.argsort(ids, kind="stable")
+                ids, encoded_sizes, sizes = ids[order], encoded_sizes[order], sizes[order]
 
-                staging.sort(key = lambda x : x.id_)
+                # Entries are laid out back to back, each starting on an
+                # alignment boundary.
+                first = _align(header["ContentOffset"], alignment)
+                aligned_sizes = _align(encoded_sizes, alignment)
+                offsets = first + np.concatenate(([0], np.cumsum(aligned_sizes)[:-1])).astype(np.int64)
 
             case 2:
-                toc = self._read_span_table(header["TocOffset"], header["TocSize"], b"TOC ").rows
-                itoc = sorted(self._read_span_table(header["ItocOffset"], header["ItocSize"], b"ITOC").rows, key = itemgetter("TocIndex"))
-
-                toc = tuple(zip(*sorted(zip(itoc, toc), key = lambda x : x[0]['ID'])))[1]
+                toc = self._read_span_array(header["TocOffset"], header["TocSize"], b"TOC ", _TOC_COLUMNS)
+                itoc = self._read_span_array(header["ItocOffset"], header["ItocSize"], b"ITOC", _ITOC_COLUMNS)
+                itoc = itoc[np.argsort(itoc["TocIndex"], kind="stable")]
+                toc_rows = np.argsort(itoc["ID"], kind="stable")
+                toc = toc[toc_rows]
 
-                for i, row in enumerate(toc):
-                    staging.append(
-                        _StagingEntry(
-                            id_ = i,
-                            encoded_size = row["FileSize"],
-                            size = row["ExtractSize"]
-                        )
-                    )
+                # Entries are not necessarily laid out back to back (e.g. after
+                # an in-place update), so take their offsets from the TOC.
+                base_offset = min(header["ContentOffset"], header["TocOffset"])
+                ids = np.arange(len(toc))
+                encoded_sizes = toc["FileSize"].astype(np.int64)
+                sizes = toc["ExtractSize"].astype(np.int64)
+                offsets = base_offset + toc["FileOffset"].astype(np.int64)
 
             case _:
                 raise NotImplementedError
 
+        index = np.empty(len(ids), _index_dtype)
+        index["id"] = ids
+        index["offset"] = offsets
+        index["encoded_size"] = encoded_sizes
+        index["size"] = sizes
+        index["toc_row"] = toc_rows
+        return index
 
-        ranges: list[_Range] = []
+    def _set_index(self, table: np.ndarray) -> None:
+        ranges: list[Range] = []
         entries: list[Entry] = []
         self._by_id: dict[int, Entry] = {}
-        alignment = header["Align"]
-        offset = header["ContentOffset"]
-        for staging_entry in staging:
-            offset += -offset % alignment
-            index = len(ranges)
-            ranges.append(
-                _Range(
-                    offset=offset,
-                    encoded_size=staging_entry.encoded_size,
-                    size=staging_entry.size,
-                ),
-            )
-            entry = Entry(
-                index=index,
-                id_=staging_entry.id_,
-            )
+        self._toc_rows = table["toc_row"]
+        for index, (id_, offset, encoded_size, size) in enumerate(
+            zip(*(table[name].tolist() for name in ("id", "offset", "encoded_size", "size")))
+        ):
+            ranges.append(Range(offset=offset, encoded_size=encoded_size, size=size))
+            entry = Entry(index=index, id_=id_)
             entries.append(entry)
-            self._by_id[staging_entry.id_] = entry
-            offset += staging_entry.encoded_size
+            self._by_id[id_] = entry
         self._ranges = tuple(ranges)
         self.entries = tuple(entries)
 
-    def _read_span_table(self, offset: int, size: int, tag: bytes) -> Table:
-        self._fp.seek(offset)
-        data = read_any_bytes(self._fp, size)
-        return self._read_table(BytesIO(data), tag)
+    def _get_names(self) -> dict[str, Entry]:
+        with self._names_lock:
+            if self._names is None:
+                self._names = self._read_names()
+        return self._names
+
+    def _read_names(self) -> dict[str, Entry]:
+        # The header is read again rather than kept around, so that readers
+        # opened from an index cache never decode it unless names are used.
+        [_, _, size] = _chunk_header.unpack(self._read_range(0, _chunk_header.size))
+        [header] = self._read_span_table(0, _chunk_header.size + size, b"CPK ").rows
+        if header["CpkMode"] != 2:
+            return {}
+
+        toc = self._read_span_table(
+            header["TocOffset"], header["TocSize"], b"TOC ", _NAME_COLUMNS
+        ).rows
+        names = [
+            f"{row['DirName']}/{row['FileName']}" if row["DirName"] else row["FileName"]
+            for row in toc
+        ]
+        return {
+            names[toc_row]: entry
+            for toc_row, entry in zip(self._toc_rows.tolist(), self.entries)
+        }
+
+    def _read_range(self, offset: int, size: int) -> bytes | memoryview:
+        if self._view is not None:
+            if offset + size > len(self._view):
+                raise EOFError
+            return self._view[offset:offset + size]
+        try:
+            fd = self._fp.fileno()
+        except (AttributeError, OSError):
+            fd = None
+        if fd is None or not hasattr(os, "pread"):
+            with self._lock:
+                self._fp.seek(offset)
+                return read_any_bytes(self._fp, size)
+        data = os.pread(fd, size, offset)
+        while len(data) < size:
+            chunk = os.pread(fd, size - len(data), offset + len(data))
+            if not chunk:
+                raise EOFError
+            data += chunk
+        return data
+
+    def _read_span_table(
+        self, offset: int, size: int, tag: bytes, columns: Iterable[str] | None = None
+    ) -> Table:
+        data = self._read_range(offset, size)
+        return decode_table(_unwrap_chunk(data, tag), columns)
+
+    def _read_span_array(
+        self, offset: int, size: int, tag: bytes, columns: Iterable[str] | None = None
+    ) -> np.ndarray:
+        data = self._read_range(offset, size)
+        return decode_array(_unwrap_chunk(data, tag), columns).array
 
     def _read_table(self, fp: BinaryIO, tag: bytes) -> Table:
-        actual_tag = read_any_bytes(fp, 4)
-        if actual_tag != tag:
-            raise ValueError(f"expected {tag!r}, got {actual_tag!r}")
-        encrypted = read_any_le_u(fp, 4) == 0
-        size = read_any_le_u(fp, 8)
-        data = read_any_bytes(fp, size)
-        if encrypted:
-            data = crypt(data)
-        return decode_table(data)
+        data = read_any_bytes(fp, _chunk_header.size)
+        data += read_any_bytes(fp, _chunk_header.unpack(data)[2])
+        return decode_table(_unwrap_chunk(data, tag))
 
 
-@dataclass(frozen=True)
-class _StagingEntry:
-    id_: int
-    encoded_size: int
-    size: int
+def _unwrap_chunk(data: bytes | memoryview, tag: bytes) -> bytes | memoryview:
+    # Unencrypted tables are returned as views of the chunk, so tables and
+    # their blob cells are decoded without intermediate copies.
+    cursor = ByteCursor(data)
+    actual_tag, flags, size = cursor.unpack(_chunk_header)
+    if actual_tag != tag:
+        raise ValueError(f"expected {tag!r}, got {actual_tag!r}")
+    data = cursor.read_any_bytes(size)
+    if flags == 0:
+        data = crypt(data)
+    return data
 
 
 @dataclass(frozen=True)
-class _Range:
-    offset: int
-    encoded_size: int
+class _IndexKey:
+    path: str
     size: int
+    mtime_ns: int
+
+
+def _index_key(fp: BinaryIO) -> _IndexKey | None:
+    try:
+        path = os.path.abspath(fp.name)
+        stat = os.fstat(fp.fileno())
+    except (AttributeError, OSError, TypeError):
+        return None
+    return _IndexKey(path, stat.st_size, stat.st_mtime_ns)
+
+
+def _index_path(index_cache: Path, key: _IndexKey) -> Path:
+    digest = hashlib.sha256(os.fsencode(key.path)).hexdigest()
+    return index_cache / f"{digest[:32]}.idx"
+
+
+def _load_index(index_cache: Path, key: _IndexKey) -> np.ndarray | None:
+    try:
+        data = _index_path(index_cache, key).read_bytes()
+        cursor = ByteCursor(data)
+        magic, size, mtime_ns, count, path_length = cursor.unpack(_index_header)
+        path = bytes(cursor.read_any_bytes(path_length))
+        entries = cursor.read_any_bytes(count * _index_dtype.itemsize)
+    except (OSError, EOFError):
+        return None
+    if (magic, size, mtime_ns, path) != (_INDEX_MAGIC, key.size, key.mtime_ns, os.fsencode(key.path)):
+        return None
+    return np.frombuffer(entries, _index_dtype, count)
+
+
+def _save_index(index_cache: Path, key: _IndexKey, index: np.ndarray) -> None:
+    path = os.fsencode(key.path)
+    data = b"".join((
+        _index_header.pack(_INDEX_MAGIC, key.size, key.mtime_ns, len(index), len(path)),
+        path,
+        index.tobytes(),
+    ))
+    # The cache is only an optimization: failing to write it is not an
+    # error, and writes go through a temporary file so that concurrent
+    # readers never see a partial index.
+    index_path = _index_path(index_cache, key)
+    temp_path = index_path.with_name(f"{index_path.name}.{os.getpid()}.tmp")
+    try:
+        index_cache.mkdir(parents=True, exist_ok=True)
+        temp_path.write_bytes(data)
+        os.replace(temp_path, index_path)
+    except OSError:
+        temp_path.unlink(missing_ok=True)
+
+
+def _align(value: Any, alignment: int) -> Any:
+    return value + (-value % alignment)
+
+
+_chunk_header = struct.Struct("<4sIQ")
+
+_INDEX_MAGIC = b"CPKIDX02"
+_index_header = struct.Struct("<8sQqQI")
+_index_dtype = np.dtype([
+    ("id", "<u4"),
+    ("offset", "<u8"),
+    ("encoded_size", "<u4"),
+    ("size", "<u4"),
+    ("toc_row", "<u4"),
+])
+
+_TOC_COLUMNS = ("FileSize", "ExtractSize", "FileOffset")
+_ITOC_COLUMNS = ("ID", "TocIndex")
+_ITOC_MODE_0_COLUMNS = ("DataL", "DataH")
+_ITOC_DATA_COLUMNS = ("ID", "FileSize", "ExtractSize")
+_NAME_COLUMNS = ("DirName", "FileName")
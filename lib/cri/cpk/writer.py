@@ -1,5 +1,11 @@
-from dataclasses import dataclass
+from collections import deque
+from concurrent.futures import Future, ProcessPoolExecutor
+from dataclasses import dataclass, replace
+import hashlib
 import os
+from pathlib import Path
+import stat
+import sys
 from typing import BinaryIO, Any
 
 from lib.codecutils import (
@@ -10,6 +16,8 @@ from lib.cri.cpk._common import (
     BODY_OFFSET,
     crypt,
 )
+from lib.cri.cpk.reader import Reader
+from lib.cri.crilayla import encode as encode_crilayla
 from lib.cri.utf import (
     Column,
     Kind,
@@ -25,49 +33,109 @@ class Config:
     alignment: int
     encrypt_tables: bool
     randomize_padding: bool
+    compress: bool = False
+    compression_threshold: int = 0
+    workers: int = 1
+    max_pending_size: int = 64 << 20
+    deduplicate: bool = False
 
 
 class Writer:
-    def __init__(self, fp: BinaryIO, config: Config):
+    def __init__(self, fp: BinaryIO, config: Config, base: Reader | None = None):
         self._fp = fp
         self._config = config
+        # When updating, `fp` is the archive `base` was read from, opened for
+        # update. Entries carried over with `keep_file` are left in place and
+        # everything else is appended past the current end of the file, so
+        # the old archive stays intact until `close()` rewrites the header.
+        self._base = base
 
         self._ids : set[int] = set()
         self._names : set[str] = set()
 
         self._staging_toc : list[_StagingTocEntry] = []
-        self._fp.seek(BODY_OFFSET)
-        self._align()
-        self._content_offset = self._fp.tell()
 
-    def write_file(self, id_: int, name: str, data: bytes) -> None:
-        if id_ in self._ids:
-            raise ValueError(f"duplicate id: {id_!r}")
-        self._ids.add(id_)
+        # With more than one worker, compression runs in a process pool and
+        # finished entries are written strictly in submission order, so the
+        # layout does not depend on scheduling. Pending input is bounded by
+        # `max_pending_size`.
+        self._executor : ProcessPoolExecutor | None = None
+        if config.compress and config.workers > 1:
+            self._executor = ProcessPoolExecutor(config.workers)
+        self._pending : deque[_PendingEntry] = deque()
+        self._pending_size = 0
 
-        if name in self._names:
-            raise ValueError(f"duplicate name: {name!r}")
-        self._names.add(name)
+        # With deduplication, entries are keyed by a digest of their
+        # uncompressed contents and repeats point at the first copy.
+        self._written : dict[bytes, _StagingTocEntry] = {}
+        self._submitted : set[bytes] = set()
+        self.deduplicated_size = 0
 
+        self._content_offset = BODY_OFFSET + -BODY_OFFSET % config.alignment
+        if base is None:
+            self._fp.seek(BODY_OFFSET)
+        else:
+            self._fp.seek(0, os.SEEK_END)
         self._align()
-        offset = self._fp.tell()
-        write_bytes(self._fp, data)
 
+    def write_file(
+        self, id_: int, name: str, data: bytes | bytearray | memoryview | Path | BinaryIO
+    ) -> None:
+        self._add_key(id_, name)
+
+        if isinstance(data, Path):
+            with open(data, "rb") as file_fp:
+                self._write_stream(id_, name, file_fp)
+        elif isinstance(data, (bytes, bytearray, memoryview)):
+            # Copied, as entries may stay pending past this call (and views
+            # may be backed by a reader's mapping).
+            self._write_data(id_, name, bytes(data))
+        else:
+            self._write_stream(id_, name, data)
+
+    def keep_file(self, id_: int, name: str) -> None:
+        if self._base is None:
+            raise ValueError("no base archive to keep files from")
+        self._add_key(id_, name)
+
+        range_ = self._base.get_range(self._base.get_by_id(id_).index)
         self._staging_toc.append(
             _StagingTocEntry(
                 id_=id_,
                 name=name,
-                offset=offset,
-                size=len(data),
+                offset=range_.offset,
+                encoded_size=range_.encoded_size,
+                size=range_.size,
             )
         )
 
+    def __enter__(self) -> "Writer":
+        return self
+
+    def __exit__(self, exc_type: Any, exc_value: Any, traceback: Any) -> None:
+        # On an error, the tables are not written and pending work is
+        # dropped; the caller decides what happens to the partial output.
+        if exc_type is None:
+            self.close()
+        else:
+            self.abort()
+
     def close(self) -> None:
+        try:
+            while self._pending:
+                self._write_pending()
+        finally:
+            self.abort()
+
+        total_encoded_size = 0
         total_size = 0
         self._staging_toc.sort(key=lambda x: x.name)
         staging_itoc : list[_StagingItocEntry]= []
         utf_toc : list[dict[str, Any]] = []
+        # Readers resolve file offsets against the lower of ContentOffset and
+        # TocOffset, which is ContentOffset as the TOC follows the content.
         for entry in self._staging_toc:
+            total_encoded_size += entry.encoded_size
             total_size += entry.size
             staging_itoc.append(
                 _StagingItocEntry(
@@ -79,9 +147,9 @@ class Writer:
                 {
                     "DirName": "",
                     "FileName": entry.name,
-                    "FileSize": entry.size,
+                    "FileSize": entry.encoded_size,
                     "ExtractSize": entry.size,
-                    "FileOffset": entry.offset - BODY_OFFSET,
+                    "FileOffset": entry.offset - self._content_offset,
                     "ID": entry.id_,
                     "UserString": "",
                 }
@@ -136,7 +204,7 @@ class Writer:
                         "GtocCrc": 0,
                         "HgtocOffset": 0,
                         "HgtocSize": 0,
-                        "EnabledPackedSize": total_size,
+                        "EnabledPackedSize": total_encoded_size,
                         "EnabledDataSize": total_size,
                         "TotalDataSize": 0,
                         "Tocs": 0,
@@ -169,6 +237,118 @@ class Writer:
             raise ValueError("info is too large")
         self._pad(BODY_OFFSET - self._fp.tell())
 
+    def abort(self) -> None:
+        self._pending.clear()
+        self._pending_size = 0
+        if self._executor is not None:
+            self._executor.shutdown(cancel_futures=True)
+            self._executor = None
+
+    def _add_key(self, id_: int, name: str) -> None:
+        if id_ in self._ids:
+            raise ValueError(f"duplicate id: {id_!r}")
+        self._ids.add(id_)
+
+        if name in self._names:
+            raise ValueError(f"duplicate name: {name!r}")
+        self._names.add(name)
+
+    def _write_stream(self, id_: int, name: str, fp: BinaryIO) -> None:
+        # Entries that are not going to be compressed are copied straight
+        # from the source without being buffered in memory.
+        size = _remaining_size(fp)
+        if self._config.compress and (size is None or size >= self._config.compression_threshold):
+            self._write_data(id_, name, fp.read())
+            return
+
+        # With deduplication, the source is hashed before anything is written,
+        # so that repeats are never copied and new entries still take the
+        # direct file-to-file copy.
+        digest : bytes | None = None
+        if self._config.deduplicate:
+            if size is None:
+                # Not seekable, so it can only be read once.
+                self._write_data(id_, name, fp.read())
+                return
+            digest = _hash_stream(fp)
+
+        while self._pending:
+            self._write_pending()
+
+        if digest is not None and digest in self._written:
+            self._add_duplicate(id_, name, digest)
+            return
+
+        self._align()
+        offset = self._fp.tell()
+        size = _copy_file(fp, self._fp)
+        self._add_entry(id_, name, offset, size, size, digest)
+
+    def _write_data(self, id_: int, name: str, data: bytes) -> None:
+        digest : bytes | None = None
+        if self._config.deduplicate:
+            digest = hashlib.sha256(data).digest()
+            if digest in self._written:
+                self._add_duplicate(id_, name, digest)
+                return
+
+        compress = self._config.compress and len(data) >= self._config.compression_threshold
+
+        if self._executor is None:
+            self._write_entry(id_, name, _compress(data) if compress else data, len(data), digest)
+            return
+
+        if digest is not None and digest in self._submitted:
+            self._pending.append(_PendingEntry(id_, name, None, len(data), digest))
+            return
+
+        encoded : bytes | Future[bytes] = data
+        if compress:
+            encoded = self._executor.submit(_compress, data)
+        if digest is not None:
+            self._submitted.add(digest)
+        self._pending.append(_PendingEntry(id_, name, encoded, len(data), digest))
+        self._pending_size += len(data)
+        while self._pending_size > self._config.max_pending_size:
+            self._write_pending()
+
+    def _write_pending(self) -> None:
+        entry = self._pending.popleft()
+        encoded = entry.encoded
+        if encoded is None:
+            assert entry.digest is not None
+            self._add_duplicate(entry.id_, entry.name, entry.digest)
+            return
+        self._pending_size -= entry.size
+        if isinstance(encoded, Future):
+            encoded = encoded.result()
+        self._write_entry(entry.id_, entry.name, encoded, entry.size, entry.digest)
+
+    def _write_entry(self, id_: int, name: str, encoded: bytes, size: int, digest: bytes | None) -> None:
+        self._align()
+        offset = self._fp.tell()
+        write_bytes(self._fp, encoded)
+        self._add_entry(id_, name, offset, len(encoded), size, digest)
+
+    def _add_entry(
+        self, id_: int, name: str, offset: int, encoded_size: int, size: int, digest: bytes | None
+    ) -> None:
+        entry = _StagingTocEntry(
+            id_=id_,
+            name=name,
+            offset=offset,
+            encoded_size=encoded_size,
+            size=size,
+        )
+        self._staging_toc.append(entry)
+        if digest is not None:
+            self._written[digest] = entry
+
+    def _add_duplicate(self, id_: int, name: str, digest: bytes) -> None:
+        original = self._written[digest]
+        self._staging_toc.append(replace(original, id_=id_, name=name))
+        self.deduplicated_size += original.encoded_size
+
     def _write_chunk_table(self, name: bytes, table: Table) -> None:
         data = encode_table(table)
         self._write_chunk(name, data, self._config.encrypt_tables)
@@ -197,11 +377,94 @@ class Writer:
         write_bytes(self._fp, padding)
 
 
+def _remaining_size(fp: BinaryIO) -> int | None:
+    try:
+        status = os.fstat(fp.fileno())
+    except (AttributeError, OSError):
+        return None
+    if not stat.S_ISREG(status.st_mode):
+        return None
+    return status.st_size - fp.tell()
+
+
+def _copy_file(src: BinaryIO, dst: BinaryIO) -> int:
+    size = _remaining_size(src)
+    if size is None:
+        return _copy_chunks(src, dst)
+
+    dst.flush()
+    src_offset = src.tell()
+    dst_offset = dst.tell()
+    src_fd = src.fileno()
+    dst_fd = dst.fileno()
+    copied = 0
+    try:
+        if hasattr(os, "copy_file_range"):
+            while copied < size:
+                count = os.copy_file_range(
+                    src_fd, dst_fd, size - copied, src_offset + copied, dst_offset + copied
+                )
+                if count == 0:
+                    break
+                copied += count
+        elif sys.platform == "linux":
+            os.lseek(dst_fd, dst_offset, os.SEEK_SET)
+            while copied < size:
+                count = os.sendfile(dst_fd, src_fd, src_offset + copied, size - copied)
+                if count == 0:
+                    break
+                copied += count
+    except OSError:
+        # Unsupported between these files (e.g. across filesystems); finish
+        # the copy through userspace from wherever the kernel stopped.
+        pass
+    src.seek(src_offset + copied)
+    dst.seek(dst_offset + copied)
+    return copied + _copy_chunks(src, dst)
+
+
+def _copy_chunks(src: BinaryIO, dst: BinaryIO) -> int:
+    copied = 0
+    while chunk := src.read(_COPY_CHUNK_SIZE):
+        write_bytes(dst, chunk)
+        copied += len(chunk)
+    return copied
+
+
+def _hash_stream(fp: BinaryIO) -> bytes:
+    start = fp.tell()
+    digest = hashlib.sha256()
+    while chunk := fp.read(_COPY_CHUNK_SIZE):
+        digest.update(chunk)
+    fp.seek(start)
+    return digest.digest()
+
+
+def _compress(data: bytes) -> bytes:
+    if len(data) < _MIN_COMPRESSED_SIZE:
+        return data
+    encoded = encode_crilayla(data)
+    if len(encoded) >= len(data):
+        return data
+    return encoded
+
+
+@dataclass(frozen=True)
+class _PendingEntry:
+    id_: int
+    name: str
+    # None for a repeat of an earlier entry with the same digest.
+    encoded: bytes | Future[bytes] | None
+    size: int
+    digest: bytes | None
+
+
 @dataclass(frozen=True)
 class _StagingTocEntry:
     id_: int
     name: str
     offset: int
+    encoded_size: int
     size: int
 
 
@@ -214,6 +477,12 @@ class _StagingItocEntry:
 _FORMAT_VERSION = 7
 _FORMAT_REVISION = 14
 
+# CRILAYLA stores the first 0x100 bytes raw, so anything shorter cannot be
+# compressed at all.
+_MIN_COMPRESSED_SIZE = 0x100
+
+_COPY_CHUNK_SIZE = 1 << 20
+
 
 _header_spec = Spec(
     name="CpkHeader",
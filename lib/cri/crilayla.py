@@ -1,6 +1,7 @@
+import struct
 from typing import BinaryIO, Iterator
 
-from lib.codecutils import read_any_bytes, read_any_le_u, read_bytes
+from lib.codecutils import ByteCursor, read_any_bytes, read_any_le_u, read_bytes
 
 
 def decode(fp: BinaryIO) -> bytes:
@@ -8,41 +9,204 @@ def decode(fp: BinaryIO) -> bytes:
     size = read_any_le_u(fp, 4)
     encoded_size = read_any_le_u(fp, 4)
     encoded_data = read_any_bytes(fp, encoded_size)
-    prefix = read_any_bytes(fp, 256)
+    prefix = read_any_bytes(fp, _PREFIX_SIZE)
     data = _decode(encoded_data, size)
     if len(data) != size:
         raise ValueError("size mismatch")
     return prefix + data
 
 
-def _decode(encoded: bytes, size: int) -> bytes:
-    stream = _BitStream(encoded)
-    buffer = bytearray()
-    while len(buffer) < size:
-        if not stream.read(1):
-            buffer.append(stream.read(8))
-        else:
-            offset = 3 + stream.read(13)
-            length = 3
-            for chunk_length in _chunk_lengths():
-                chunk = stream.read(chunk_length)
-                length += chunk
-                if chunk != (1 << chunk_length) - 1:
-                    break
-            _copy(buffer, len(buffer) - offset, length)
-    if len(buffer) != size:
+def decode_buffer(data: bytes | memoryview) -> bytes:
+    cursor = ByteCursor(data)
+    cursor.read_bytes(b"CRILAYLA")
+    size, encoded_size = cursor.unpack(_sizes)
+    encoded_data = cursor.read_any_bytes(encoded_size)
+    prefix = cursor.read_any_bytes(_PREFIX_SIZE)
+    data = _decode(encoded_data, size)
+    if len(data) != size:
         raise ValueError("size mismatch")
+    return bytes(prefix) + data
+
+
+def encode(data: bytes) -> bytes:
+    if len(data) < _PREFIX_SIZE:
+        raise ValueError("data is too short")
+    prefix = data[:_PREFIX_SIZE]
+    body = data[_PREFIX_SIZE:][::-1]
+    encoded = _encode(body)
+    return (
+        b"CRILAYLA"
+        + len(body).to_bytes(4, "little")
+        + len(encoded).to_bytes(4, "little")
+        + encoded
+        + prefix
+    )
+
+
+def _decode(encoded: bytes | memoryview, size: int) -> bytes:
+    # The bitstream is consumed from the last byte towards the first, most
+    # significant bit first, so refills interpret the bytes preceding the
+    # cursor as a little-endian integer and shift them in below the bits
+    # already buffered. Only a bounded window of bits is ever held.
+    position = len(encoded)
+    bits = 0
+    available = 0
+
+    buffer = bytearray(size)
+    written = 0
+    while written < size:
+        if available < _REFILL_THRESHOLD and position:
+            position, bits, available = _refill(encoded, position, bits, available)
+
+        if available < 9:
+            raise EOFError
+        available -= 1
+        if not (bits >> available) & 1:
+            available -= 8
+            buffer[written] = (bits >> available) & 0xFF
+            written += 1
+            continue
+
+        if available < 13:
+            raise EOFError
+        available -= 13
+        offset = 3 + ((bits >> available) & 0x1FFF)
+        length = 3
+        for chunk_length in _chunk_lengths():
+            if available < chunk_length:
+                position, bits, available = _refill(encoded, position, bits, available)
+                if available < chunk_length:
+                    raise EOFError
+            available -= chunk_length
+            chunk_mask = (1 << chunk_length) - 1
+            chunk = (bits >> available) & chunk_mask
+            length += chunk
+            if chunk != chunk_mask:
+                break
+
+        start = written - offset
+        if start < 0:
+            raise ValueError("invalid back-reference")
+        end = written + length
+        if end > size:
+            raise ValueError("size mismatch")
+        if offset >= length:
+            buffer[written:end] = buffer[start:start + length]
+        else:
+            pattern = buffer[start:written]
+            buffer[written:end] = (pattern * (length // offset + 1))[:length]
+        written = end
+
     buffer.reverse()
     return bytes(buffer)
 
 
-def _copy(buffer: bytearray, start: int, length: int) -> None:
-    data = bytes(buffer[start:])
-    data_length = len(data)
-    while length:
-        chunk_length = min(length, data_length)
-        buffer += data[:chunk_length]
-        length -= chunk_length
+def _encode(data: bytes) -> bytes:
+    # Greedy LZ77 over the reversed payload; `head` maps each 3-byte key to
+    # the most recent position it was seen at and `chain` links every
+    # position to the previous one with the same key.
+    writer = _BitWriter()
+    head: dict[bytes, int] = {}
+    chain = [-1] * len(data)
+    size = len(data)
+    position = 0
+    while position < size:
+        best_length = 0
+        best_distance = 0
+        limit = size - position
+        if limit >= _MIN_MATCH:
+            candidate = head.get(data[position:position + _MIN_MATCH], -1)
+            depth = _MAX_CHAIN_DEPTH
+            while candidate >= 0 and depth:
+                distance = position - candidate
+                if distance > _MAX_DISTANCE:
+                    break
+                if (
+                    distance >= _MIN_DISTANCE
+                    and data[candidate + best_length] == data[position + best_length]
+                ):
+                    length = _match_length(data, candidate, position, limit)
+                    if length > best_length:
+                        best_length = length
+                        best_distance = distance
+                        if length == limit:
+                            break
+                candidate = chain[candidate]
+                depth -= 1
+
+        if best_length < _MIN_MATCH:
+            writer.write(9, data[position])
+            best_length = 1
+        else:
+            writer.write(14, (1 << 13) | (best_distance - _MIN_DISTANCE))
+            rest = best_length - _MIN_MATCH
+            for chunk_length in _chunk_lengths():
+                chunk_mask = (1 << chunk_length) - 1
+                if rest < chunk_mask:
+                    writer.write(chunk_length, rest)
+                    break
+                writer.write(chunk_length, chunk_mask)
+                rest -= chunk_mask
+
+        end = position + best_length
+        indexed_end = min(end, size - _MIN_MATCH + 1)
+        while position < indexed_end:
+            key = data[position:position + _MIN_MATCH]
+            chain[position] = head.get(key, -1)
+            head[key] = position
+            position += 1
+        position = end
+    return writer.getvalue()
+
+
+def _match_length(data: bytes, a: int, b: int, limit: int) -> int:
+    length = 0
+    step = _MIN_MATCH
+    while length < limit:
+        step = min(step, limit - length)
+        if data[a + length:a + length + step] == data[b + length:b + length + step]:
+            length += step
+            step *= 2
+        elif step > 1:
+            step //= 2
+        else:
+            break
+    return length
+
+
+class _BitWriter:
+    def __init__(self) -> None:
+        self._buffer = bytearray()
+        self._bits = 0
+        self._count = 0
+
+    def write(self, count: int, value: int) -> None:
+        self._bits = (self._bits << count) | value
+        self._count += count
+        if self._count >= 32:
+            self._count -= 32
+            self._buffer += (self._bits >> self._count).to_bytes(4, "big")
+            self._bits &= (1 << self._count) - 1
+
+    def getvalue(self) -> bytes:
+        # Bits are emitted most significant first and the bytes reversed at
+        # the end, mirroring the back-to-front reads in `_decode`.
+        buffer = self._buffer
+        if self._count:
+            padding = -self._count % 8
+            buffer += (self._bits << padding).to_bytes((self._count + padding) // 8, "big")
+        buffer.reverse()
+        return bytes(buffer)
+
+
+def _refill(
+    encoded: bytes | memoryview, position: int, bits: int, available: int
+) -> tuple[int, int, int]:
+    count = min(position, _REFILL_BYTES)
+    bits &= (1 << available) - 1
+    bits <<= 8 * count
+    bits |= int.from_bytes(encoded[position - count:position], "little")
+    return position - count, bits, available + 8 * count
 
 
 def _chunk_lengths() -> Iterator[int]:
@@ -51,13 +215,14 @@ def _chunk_lengths() -> Iterator[int]:
         yield 8
 
 
-class _BitStream:
-    def __init__(self, data: bytes) -> None:
-        self._data = int.from_bytes(data, "little")
-        self._remaining = 8 * len(data)
+_PREFIX_SIZE = 0x100
+
+_sizes = struct.Struct("<II")
+
+_MIN_MATCH = 3
+_MIN_DISTANCE = 3
+_MAX_DISTANCE = 0x1FFF + _MIN_DISTANCE
+_MAX_CHAIN_DEPTH = 64
 
-    def read(self, count: int) -> int:
-        bits = self._data >> (self._remaining - count)
-        bits &= (1 << count) - 1
-        self._remaining -= count
-        return bits
+_REFILL_BYTES = 8
+_REFILL_THRESHOLD = 32
@@ -1,20 +1,17 @@
 from dataclasses import dataclass
 from enum import IntEnum
-from io import BytesIO
-from typing import Any, BinaryIO
+from functools import lru_cache
+import struct
+from typing import Any, BinaryIO, Iterable, Iterator, Sequence, overload
+
+import numpy as np
 
 from lib.codecutils import (
+    ByteCursor,
     write_bytes,
-    write_be_u,
-    write_be_s,
-    write_be_f4,
-    write_be_f8,
     read_any_bytes,
     read_bytes,
     read_any_be_u,
-    read_any_be_s,
-    read_any_be_f4,
-    read_any_be_f8,
 )
 
 
@@ -62,34 +59,39 @@ class Spec:
 @dataclass(frozen=True)
 class Table:
     spec: Spec
-    rows: tuple[dict[str, Any], ...]
+    rows: Sequence[dict[str, Any]]
+
+
+@dataclass(frozen=True)
+class ArrayTable:
+    spec: Spec
+    # One big-endian field per column; string columns hold heap offsets and
+    # blob columns (offset, size) pairs.
+    array: np.ndarray
 
 
 def encode(table: Table) -> bytes:
-    buffer = BytesIO()
-    write(buffer, table)
-    return buffer.getvalue()
+    return bytes(_Writer(table).build())
 
 
-def decode(data: bytes) -> Table:
-    return read(BytesIO(data))
+def decode(data: bytes | memoryview, columns: Iterable[str] | None = None) -> Table:
+    return _Reader(_unwrap(data), columns).read()
 
 
-def write(fp: BinaryIO, table: Table) -> None:
-    buffer = BytesIO()
-    _Writer(buffer, table).write()
-    _write_wrapper(fp, buffer.getvalue())
+def decode_lazy(data: bytes | memoryview, columns: Iterable[str] | None = None) -> Table:
+    return _Reader(_unwrap(data), columns).read(lazy=True)
 
 
-def read(fp: BinaryIO) -> Table:
-    buffer = BytesIO(_read_wrapper(fp))
-    return _Reader(buffer).read()
+def decode_array(data: bytes | memoryview, columns: Iterable[str] | None = None) -> ArrayTable:
+    return _Reader(_unwrap(data), columns).read_array()
 
 
-def _write_wrapper(fp: BinaryIO, data: bytes) -> None:
-    write_bytes(fp, b"@UTF")
-    write_be_u(fp, 4, len(data))
-    write_bytes(fp, data)
+def write(fp: BinaryIO, table: Table) -> None:
+    write_bytes(fp, _Writer(table).build())
+
+
+def read(fp: BinaryIO, columns: Iterable[str] | None = None) -> Table:
+    return _Reader(_read_wrapper(fp), columns).read()
 
 
 def _read_wrapper(fp: BinaryIO) -> bytes:
@@ -98,54 +100,59 @@ def _read_wrapper(fp: BinaryIO) -> bytes:
     return read_any_bytes(fp, length)
 
 
+def _unwrap(data: bytes | memoryview) -> memoryview:
+    # Slices the table out of an in-memory wrapper without copying it.
+    cursor = ByteCursor(data)
+    cursor.read_bytes(b"@UTF")
+    [length] = cursor.unpack(_length)
+    return cursor.read_any_bytes(length)
+
+
 class _Writer:
-    def __init__(self, fp: BinaryIO, table: Table):
-        self._fp = fp
+    def __init__(self, table: Table):
         self._table = table
         self._chars = _CharsBuilder()
         self._bytes = _BytesBuilder()
 
-    def write(self) -> None:
+    def build(self) -> bytearray:
+        # Every section size is known once the heaps are complete, so the
+        # whole table, wrapper included, is laid out in one buffer without
+        # back-patching offsets.
         name_offset = self._chars.add(self._table.spec.name)
-
-        write_be_u(self._fp, 2, self._table.spec.string_encoding)
-        rows_offset_position = self._fp.tell()
-        write_be_u(self._fp, 2, 0)
-        strings_offset_position = self._fp.tell()
-        write_be_u(self._fp, 4, 0)
-        blobs_offset_position = self._fp.tell()
-        write_be_u(self._fp, 4, 0)
-        write_be_u(self._fp, 4, name_offset)
-        write_be_u(self._fp, 2, len(self._table.spec.columns))
-        row_size_position = self._fp.tell()
-        write_be_u(self._fp, 2, 0)
-        write_be_u(self._fp, 4, len(self._table.rows))
-
-        self._write_columns()
-
-        rows_offset = self._fp.tell()
-        self._write_rows()
-
-        strings_offset = self._fp.tell()
-        self._chars.build(self._fp)
-
-        write_bytes(self._fp, bytes(-self._fp.tell() % 8))
-        blobs_offset = self._fp.tell()
-        self._bytes.build(self._fp)
-        write_bytes(self._fp, bytes(-self._fp.tell() % 8))
-
-        tmp = self._fp.tell()
-        self._fp.seek(rows_offset_position)
-        write_be_u(self._fp, 2, rows_offset)
-        self._fp.seek(strings_offset_position)
-        write_be_u(self._fp, 4, strings_offset)
-        self._fp.seek(blobs_offset_position)
-        write_be_u(self._fp, 4, blobs_offset)
-        self._fp.seek(row_size_position)
-        write_be_u(self._fp, 2, self._row_size)
-        self._fp.seek(tmp)
-
-    def _write_columns(self) -> None:
+        columns = self._build_columns()
+        codec, rows = self._build_rows()
+
+        rows_offset = _header.size - 8 + len(columns)
+        row_size = codec.struct.size if rows else 0
+        strings_offset = rows_offset + row_size * len(rows)
+        blobs_offset = _align(strings_offset + len(self._chars.data), 8)
+        size = _align(blobs_offset + len(self._bytes.data), 8)
+
+        buffer = bytearray(8 + size)
+        cursor = ByteCursor(buffer)
+        cursor.pack(
+            _header,
+            b"@UTF",
+            size,
+            self._table.spec.string_encoding,
+            rows_offset,
+            strings_offset,
+            blobs_offset,
+            name_offset,
+            len(self._table.spec.columns),
+            row_size,
+            len(rows),
+        )
+        cursor.write_bytes(columns)
+        for values in rows:
+            cursor.pack(codec.struct, *values)
+        cursor.write_bytes(self._chars.data)
+        cursor.seek(8 + blobs_offset)
+        cursor.write_bytes(self._bytes.data)
+        return buffer
+
+    def _build_columns(self) -> bytes:
+        columns : list[bytes] = []
         constants : list[Any] = []
         for column in self._table.spec.columns:
             constant = None
@@ -169,72 +176,57 @@ class _Writer:
             info = (storage << 4) | kind
             name_offset = self._chars.add(column.name)
 
-            write_be_u(self._fp, 1, info)
-            write_be_u(self._fp, 4, name_offset)
+            columns.append(_column_info.pack(info, name_offset))
             if storage == _Storage.CONSTANT:
-                self._write_value(kind, constant)
+                columns.append(self._pack_value(kind, constant))
         self._constants = constants
-
-    def _write_rows(self) -> None:
-        row_size = 0
-        for i in range(len(self._table.rows)):
-            row_start = self._fp.tell()
-            self._write_row(i)
-            row_size = self._fp.tell() - row_start
-        self._row_size = row_size
-
-    def _write_row(self, index: int) -> None:
-        row = self._table.rows[index]
-        for column, constant in zip(self._table.spec.columns, self._constants):
-            value = row[column.name]
-            if not constant:
-                self._write_value(column.kind, value)
-
-    def _write_value(self, kind: Kind, value: Any) -> None:
+        return b"".join(columns)
+
+    def _build_rows(self) -> tuple["_Codec", list[list[Any]]]:
+        codec = _compile_codec(
+            tuple(
+                (column.name, column.kind)
+                for column, constant in zip(self._table.spec.columns, self._constants)
+                if not constant
+            )
+        )
+        rows : list[list[Any]] = []
+        for row in self._table.rows:
+            values = [row[name] for name in codec.fields]
+            for _, index in codec.chars:
+                values[index] = self._chars.add(values[index])
+            for _, index in codec.blobs:
+                value = values[index]
+                values[index] = self._bytes.add(value)
+                values[index + 1] = len(value)
+            rows.append(values)
+        return codec, rows
+
+    def _pack_value(self, kind: Kind, value: Any) -> bytes:
         match kind:
-            case Kind.U1:
-                write_be_u(self._fp, 1, value)
-            case Kind.S1:
-                write_be_s(self._fp, 1, value)
-            case Kind.U2:
-                write_be_u(self._fp, 2, value)
-            case Kind.S2:
-                write_be_s(self._fp, 2, value)
-            case Kind.U4:
-                write_be_u(self._fp, 4, value)
-            case Kind.S4:
-                write_be_s(self._fp, 4, value)
-            case Kind.U8:
-                write_be_u(self._fp, 8, value)
-            case Kind.S8:
-                write_be_s(self._fp, 8, value)
-            case Kind.F4:
-                write_be_f4(self._fp, value)
-            case Kind.F8:
-                write_be_f8(self._fp, value)
             case Kind.Chars:
-                write_be_u(self._fp, 4, self._chars.add(value))
+                values = (self._chars.add(value),)
             case Kind.Bytes:
-                write_be_u(self._fp, 4, self._bytes.add(value))
-                write_be_u(self._fp, 4, len(value))
+                values = (self._bytes.add(value), len(value))
             case _:
-                raise NotImplementedError(kind)
+                values = (value,)
+        return struct.pack(">" + _formats[kind], *values)
 
 
 class _CharsBuilder:
     def __init__(self):
         self.data = bytearray(b"<NULL>\x00")
+        self._offsets : dict[str, int] = {"": 0}
 
     def add(self, value: str) -> int:
-        if not value:
-            return 0
-        offset = len(self.data)
-        self.data += value.encode("utf-8") + b"\x00"
+        # Column names and repeated values are interned to a single copy.
+        offset = self._offsets.get(value)
+        if offset is None:
+            offset = len(self.data)
+            self.data += value.encode("utf-8") + b"\x00"
+            self._offsets[value] = offset
         return offset
 
-    def build(self, fp: BinaryIO) -> None:
-        fp.write(self.data)
-
 
 class _BytesBuilder:
     def __init__(self):
@@ -247,23 +239,72 @@ class _BytesBuilder:
         self.data += value
         return offset
 
-    def build(self, fp: BinaryIO) -> None:
-        fp.write(self.data)
-
 
 class _Reader:
-    def __init__(self, fp: BinaryIO):
-        self._fp = fp
-
-    def read(self) -> Table:
-        self._chars_encoding = CharsEncoding(read_any_be_u(self._fp, 2))
-        self._rows_offset = read_any_be_u(self._fp, 2)
-        self._strings_offset = read_any_be_u(self._fp, 4)
-        self._blobs_offset = read_any_be_u(self._fp, 4)
-        self._name_offset = read_any_be_u(self._fp, 4)
-        self._column_count = read_any_be_u(self._fp, 2)
-        self._row_size = read_any_be_u(self._fp, 2)
-        self._row_count = read_any_be_u(self._fp, 4)
+    def __init__(self, data: bytes | memoryview, columns: Iterable[str] | None = None):
+        # Rows and blobs are read from views of the table buffer; only the
+        # string heap is materialized, for NUL lookups.
+        self._data = memoryview(data)
+        self._cursor = ByteCursor(self._data)
+        # Columns left out of a projection are skipped while unpacking, so
+        # their strings and blobs are never looked up.
+        self._selection = None if columns is None else frozenset(columns)
+        self._chars: dict[int, str] = {}
+        # Raw heap references of constant string/blob columns.
+        self._heap_constants: dict[str, tuple[int, ...]] = {}
+
+    def read(self, lazy: bool = False) -> Table:
+        spec = self._read_spec()
+        rows = _Rows(self, self._compile_rows())
+        return Table(
+            spec=spec,
+            rows=rows if lazy else tuple(rows),
+        )
+
+    def read_array(self) -> ArrayTable:
+        spec = self._read_spec()
+        self._compile_rows()
+
+        array = np.zeros(self._row_count, _compile_dtype(spec.columns))
+        columns = tuple(
+            column
+            for column, constant in zip(self._columns, self._constants)
+            if constant is None
+        )
+        if columns and self._row_count:
+            rows = np.frombuffer(
+                self._data,
+                _compile_dtype(columns),
+                count=self._row_count,
+                offset=self._rows_offset,
+            )
+            for column in columns:
+                if self._is_selected(column.name):
+                    array[column.name] = rows[column.name]
+        for column, constant in zip(self._columns, self._constants):
+            if constant is None or not self._is_selected(column.name):
+                continue
+            if column.kind in (Kind.Chars, Kind.Bytes):
+                constant = self._heap_constants.get(column.name, 0)
+            array[column.name] = constant
+        return ArrayTable(spec, array)
+
+    def _read_spec(self) -> Spec:
+        (
+            chars_encoding,
+            self._rows_offset,
+            self._strings_offset,
+            self._blobs_offset,
+            self._name_offset,
+            self._column_count,
+            self._row_size,
+            self._row_count,
+        ) = self._cursor.unpack(_table_header)
+        self._chars_encoding = CharsEncoding(chars_encoding)
+        strings_end = len(self._data)
+        if self._strings_offset <= self._blobs_offset:
+            strings_end = self._blobs_offset
+        self._strings = bytes(self._data[self._strings_offset:strings_end])
 
         match self._chars_encoding:
             case CharsEncoding.CP932:
@@ -275,13 +316,15 @@ class _Reader:
 
         self._read_columns()
         name = self._read_chars(self._name_offset)
-        rows : list[dict[str, Any]] = []
-        for _ in range(self._row_count):
-            rows.append(self._read_row())
-        return Table(
-            spec=Spec(name, self._columns, self._chars_encoding),
-            rows=tuple(rows),
-        )
+        if self._selection is not None:
+            missing = self._selection.difference(column.name for column in self._columns)
+            if missing:
+                raise ValueError(f"unknown columns: {', '.join(sorted(missing))}")
+        columns = tuple(column for column in self._columns if self._is_selected(column.name))
+        return Spec(name, columns, self._chars_encoding)
+
+    def _is_selected(self, name: str) -> bool:
+        return self._selection is None or name in self._selection
 
     def _read_columns(self) -> None:
         columns: list[Column] = []
@@ -294,18 +337,26 @@ class _Reader:
         self._constants = tuple(constants)
 
     def _read_column(self) -> tuple[Column, Any | None]:
-        info = read_any_be_u(self._fp, 1)
+        info, name_offset = self._cursor.unpack(_column_info)
         kind = Kind(info & 0xF)
         storage = _Storage(info >> 4)
-
-        name_offset = read_any_be_u(self._fp, 4)
         name = self._read_chars(name_offset)
 
         match storage:
             case _Storage.DEFAULT:
                 constant = _default_values[kind]
             case _Storage.CONSTANT:
-                constant = self._read_value(kind)
+                values = self._cursor.unpack(_value_formats[kind])
+                if not self._is_selected(name):
+                    constant = _default_values[kind]
+                elif kind == Kind.Chars:
+                    self._heap_constants[name] = values
+                    constant = self._read_chars(*values)
+                elif kind == Kind.Bytes:
+                    self._heap_constants[name] = values
+                    constant = self._read_bytes(*values)
+                else:
+                    [constant] = values
             case _Storage.NORMAL:
                 constant = None
             case _:
@@ -313,71 +364,164 @@ class _Reader:
 
         return Column(name, kind), constant
 
-    def _read_row(self) -> dict[str, Any]:
-        row : dict[str, Any] = {}
-        for column, constant in zip(self._columns, self._constants):
-            kind = column.kind
-            value = constant
-            if value is None:
-                value = self._read_value(kind)
-            row[column.name] = value
+    def _compile_rows(self) -> "_RowLayout":
+        codec = _compile_codec(
+            tuple(
+                (column.name, column.kind)
+                for column, constant in zip(self._columns, self._constants)
+                if constant is None
+            ),
+            frozenset(
+                column.name
+                for column in self._columns
+                if not self._is_selected(column.name)
+            ),
+        )
+        if self._row_count and self._row_size != codec.struct.size:
+            raise ValueError(f"expected row size {codec.struct.size}, got {self._row_size}")
+
+        # Rows start out as a copy of a template holding the constants, in
+        # column order; per-row fields are then filled in from the unpacked
+        # struct and string/blob offsets resolved.
+        template = {
+            column.name: constant
+            for column, constant in zip(self._columns, self._constants)
+            if self._is_selected(column.name)
+        }
+        end = self._rows_offset + self._row_count * self._row_size
+        if end > len(self._data):
+            raise EOFError
+        return _RowLayout(codec, template)
+
+    def _read_row(self, layout: "_RowLayout", values: tuple[Any, ...]) -> dict[str, Any]:
+        codec = layout.codec
+        row = layout.template.copy()
+        row.update(zip(codec.fields, values))
+        for name, index in codec.chars:
+            row[name] = self._read_chars(values[index])
+        for name, index in codec.blobs:
+            row[name] = self._read_bytes(values[index], values[index + 1])
         return row
 
-    def _read_value(self, kind: Kind) -> Any:
-        match kind:
-            case Kind.U1:
-                return read_any_be_u(self._fp, 1)
-            case Kind.S1:
-                return read_any_be_s(self._fp, 1)
-            case Kind.U2:
-                return read_any_be_u(self._fp, 2)
-            case Kind.S2:
-                return read_any_be_s(self._fp, 2)
-            case Kind.U4:
-                return read_any_be_u(self._fp, 4)
-            case Kind.S4:
-                return read_any_be_s(self._fp, 4)
-            case Kind.U8:
-                return read_any_be_u(self._fp, 8)
-            case Kind.S8:
-                return read_any_be_s(self._fp, 8)
-            case Kind.F4:
-                return read_any_be_f4(self._fp)
-            case Kind.F8:
-                return read_any_be_f8(self._fp)
-            case Kind.Chars:
-                return self._read_chars(
-                    read_any_be_u(self._fp, 4),
-                )
-            case Kind.Bytes:
-                return self._read_bytes(
-                    read_any_be_u(self._fp, 4),
-                    read_any_be_u(self._fp, 4),
-                )
-            case _:
-                raise NotImplementedError(kind)
-
     def _read_chars(self, offset: int) -> str:
         if offset == 0:
             return ""
-        buffer = bytearray()
-        tmp = self._fp.tell()
-        self._fp.seek(self._strings_offset + offset)
-        while True:
-            b = read_any_be_u(self._fp, 1)
-            if b == 0x00:
-                break
-            buffer.append(b)
-        self._fp.seek(tmp)
-        return buffer.decode(self._chars_encoding_name)
-
-    def _read_bytes(self, offset: int, length: int) -> bytes:
-        tmp = self._fp.tell()
-        self._fp.seek(self._blobs_offset + offset)
-        value = read_any_bytes(self._fp, length)
-        self._fp.seek(tmp)
+        # Column names and repeated values share heap offsets, so each
+        # offset is decoded at most once.
+        value = self._chars.get(offset)
+        if value is None:
+            end = self._strings.find(b"\x00", offset)
+            if end < 0:
+                raise EOFError
+            value = self._strings[offset:end].decode(self._chars_encoding_name)
+            self._chars[offset] = value
         return value
 
+    def _read_bytes(self, offset: int, length: int) -> memoryview:
+        start = self._blobs_offset + offset
+        if start + length > len(self._data):
+            raise EOFError
+        return self._data[start:start + length]
+
+
+@dataclass(frozen=True)
+class _RowLayout:
+    codec: "_Codec"
+    template: dict[str, Any]
+
+
+class _Rows(Sequence[dict[str, Any]]):
+    # Rows decoded on access from the table buffer, so callers that only
+    # look at a few rows never build the others.
+    def __init__(self, reader: _Reader, layout: _RowLayout):
+        self._reader = reader
+        self._layout = layout
+
+    def __len__(self) -> int:
+        return self._reader._row_count
+
+    @overload
+    def __getitem__(self, index: int) -> dict[str, Any]: ...
+
+    @overload
+    def __getitem__(self, index: slice) -> tuple[dict[str, Any], ...]: ...
+
+    def __getitem__(self, index: int | slice) -> dict[str, Any] | tuple[dict[str, Any], ...]:
+        if isinstance(index, slice):
+            return tuple(self[i] for i in range(*index.indices(len(self))))
+        if index < 0:
+            index += len(self)
+        if not 0 <= index < len(self):
+            raise IndexError("row index out of range")
+        reader = self._reader
+        row_struct = self._layout.codec.struct
+        values = row_struct.unpack_from(reader._data, reader._rows_offset + index * row_struct.size)
+        return reader._read_row(self._layout, values)
+
+    def __iter__(self) -> Iterator[dict[str, Any]]:
+        reader = self._reader
+        row_struct = self._layout.codec.struct
+        unpacked : Iterable[tuple[Any, ...]] = [()] * len(self)
+        if row_struct.size:
+            start = reader._rows_offset
+            end = start + len(self) * row_struct.size
+            unpacked = row_struct.iter_unpack(reader._data[start:end])
+        for values in unpacked:
+            yield reader._read_row(self._layout, values)
+
+
+@dataclass(frozen=True)
+class _Codec:
+    columns: tuple[tuple[str, Kind], ...]
+    struct: struct.Struct
+    # Column name for each struct field (blobs take two: offset and length).
+    fields: tuple[str, ...]
+    # Field index of each string offset and blob offset.
+    chars: tuple[tuple[str, int], ...]
+    blobs: tuple[tuple[str, int], ...]
+
+
+@lru_cache(maxsize=None)
+def _compile_codec(
+    columns: tuple[tuple[str, Kind], ...],
+    skipped: frozenset[str] = frozenset(),
+) -> _Codec:
+    # One big-endian row format per layout of per-row columns, so whole rows
+    # are packed and unpacked in a single call. Skipped columns become pad
+    # bytes and produce no fields.
+    formats : list[str] = []
+    fields : list[str] = []
+    chars : list[tuple[str, int]] = []
+    blobs : list[tuple[str, int]] = []
+    for name, kind in columns:
+        format_ = _formats[kind]
+        if name in skipped:
+            formats.append(f"{struct.calcsize('>' + format_)}x")
+            continue
+        formats.append(format_)
+        if kind == Kind.Chars:
+            chars.append((name, len(fields)))
+        elif kind == Kind.Bytes:
+            blobs.append((name, len(fields)))
+            fields.append(name)
+        fields.append(name)
+    return _Codec(
+        columns=columns,
+        struct=struct.Struct(">" + "".join(formats)),
+        fields=tuple(fields),
+        chars=tuple(chars),
+        blobs=tuple(blobs),
+    )
+
+
+@lru_cache(maxsize=None)
+def _compile_dtype(columns: tuple[Column, ...]) -> np.dtype:
+    return np.dtype([(column.name, *_dtypes[column.kind]) for column in columns])
+
+
+def _align(value: int, alignment: int) -> int:
+    return value + (-value % alignment)
+
 
 class _Storage(IntEnum):
     DEFAULT = 1
@@ -389,6 +533,45 @@ class _Storage(IntEnum):
         return f"{cls_name}.{self.name}"
 
 
+_header = struct.Struct(">4sIHHIIIHHI")
+_table_header = struct.Struct(">HHIIIHHI")
+_length = struct.Struct(">I")
+_column_info = struct.Struct(">BI")
+
+_formats : dict[Kind, str] = {
+    Kind.U1: "B",
+    Kind.S1: "b",
+    Kind.U2: "H",
+    Kind.S2: "h",
+    Kind.U4: "I",
+    Kind.S4: "i",
+    Kind.U8: "Q",
+    Kind.S8: "q",
+    Kind.F4: "f",
+    Kind.F8: "d",
+    Kind.Chars: "I",
+    Kind.Bytes: "II",
+}
+
+_value_formats : dict[Kind, struct.Struct] = {
+    kind: struct.Struct(">" + format_) for kind, format_ in _formats.items()
+}
+
+_dtypes : dict[Kind, tuple[Any, ...]] = {
+    Kind.U1: (">u1",),
+    Kind.S1: (">i1",),
+    Kind.U2: (">u2",),
+    Kind.S2: (">i2",),
+    Kind.U4: (">u4",),
+    Kind.S4: (">i4",),
+    Kind.U8: (">u8",),
+    Kind.S8: (">i8",),
+    Kind.F4: (">f4",),
+    Kind.F8: (">f8",),
+    Kind.Chars: (">u4",),
+    Kind.Bytes: (">u4", (2,)),
+}
+
 _default_values : dict[Kind, Any] = {
     Kind.U1: 0,
     Kind.S1: 0,
@@ -0,0 +1,102 @@
+"""
+`lib.manifest` houses `BuildManifest`, which records what each stage of a build was last run against,
+so that `build.py` can skip the stages whose inputs have not changed since.
+"""
+
+import hashlib
+import json
+import os
+
+from pathlib import Path
+from typing import Any, Self
+
+class BuildManifest:
+	"""
+	A stage's key is a hash over the digests of everything it depends on (usually including the key
+	of the stage before it, so that changes cascade). Once a stage completes, its key is recorded in
+	a JSON file in the build directory; on the next build, the stage is current if its key is the same
+	and its outputs still exist.
+
+	File digests are content hashes, but are cached by path, size and modification time, so that
+	unchanged inputs (including the large source archives) are not read again on every build.
+	"""
+	def __init__(self : Self, path : Path, clean : bool):
+		self.path = path
+		self.stages : dict[str, str] = {}
+		self.files  : dict[str, dict[str, Any]] = {}
+		if not clean and path.exists():
+			try:
+				data = json.loads(path.read_text(encoding="utf-8"))
+				self.stages = data["stages"]
+				self.files = data["files"]
+			except (ValueError, KeyError):
+				pass
+
+	def key(self : Self, stage : str, *inputs : str) -> str:
+		return digest_values(stage, *inputs)
+
+	def is_current(self : Self, stage : str, key : str, *outputs : Path) -> bool:
+		"""
+		Returns whether `stage` last completed with `key` and all of its `outputs` are present.
+		If not, the stage's record is dropped before it gets run again, so that a build interrupted
+		halfway through a stage never leaves it looking complete.
+		"""
+		if self.stages.get(stage) == key and all(output.exists() for output in outputs):
+			return True
+		if self.stages.pop(stage, None) is not None:
+			self.save()
+		return False
+
+	def record(self : Self, stage : str, key : str) -> None:
+		self.stages[stage] = key
+		self.save()
+
+	def digest_paths(self : Self, *paths : Path) -> str:
+		"""
+		Digest of the given files and directories (recursively), including their names.
+		Missing paths are hashed as such, so that their later appearance invalidates the digest.
+		"""
+		digest = hashlib.sha256()
+		for path in paths:
+			if path.is_dir():
+				for root, dirs, files in os.walk(path):
+					dirs.sort()
+					for name in sorted(files):
+						file_path = Path(root, name)
+						digest.update(f"{ file_path.relative_to(path).as_posix() }\0".encode())
+						digest.update(bytes.fromhex(self.digest_file(file_path)))
+			elif path.is_file():
+				digest.update(bytes.fromhex(self.digest_file(path)))
+			else:
+				digest.update(b"missing\0")
+			digest.update(f"{ path.as_posix() }\0".encode())
+		return digest.hexdigest()
+
+	def digest_file(self : Self, path : Path) -> str:
+		stat = path.stat()
+		cached = self.files.get(str(path))
+		if cached is not None and cached["size"] == stat.st_size and cached["mtime_ns"] == stat.st_mtime_ns:
+			return cached["digest"]
+
+		digest = hashlib.sha256()
+		with open(path, "rb") as f:
+			while chunk := f.read(1 << 20):
+				digest.update(chunk)
+		self.files[str(path)] = {
+			"size": stat.st_size,
+			"mtime_ns": stat.st_mtime_ns,
+			"digest": digest.hexdigest(),
+		}
+		return digest.hexdigest()
+
+	def save(self : Self) -> None:
+		self.path.parent.mkdir(parents=True, exist_ok=True)
+		temp_path = self.path.with_name(f"{ self.path.name }.tmp")
+		temp_path.write_text(json.dumps({ "stages": self.stages, "files": self.files }, indent="\t"), encoding="utf-8")
+		os.replace(temp_path, self.path)
+
+def digest_values(*values : object) -> str:
+	digest = hashlib.sha256()
+	for value in values:
+		digest.update(f"{ value!r}\0".encode())
+	return digest.hexdigest()
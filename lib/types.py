@@ -6,6 +6,7 @@ from __future__ import annotations
 
 from enum import StrEnum, auto
 from dataclasses import dataclass, asdict
+from fnmatch import fnmatchcase
 
 from typing import Self, Literal, Any, cast, assert_never
 
@@ -97,6 +98,25 @@ class StringUnitEncoding(StrEnum):
     UInt32 = "UInt32"
 
 
+@dataclass(frozen = True)
+class EntryFilter:
+    """
+    Selects which entries of an archive get extracted, so that small rebuilds only pay for the
+    scripts they touch rather than for the whole archive.
+    An entry is selected if its ID is in `ids`, its name (as listed in the cls file) is in `names`,
+    or its name matches any of the shell-style patterns in `globs`.
+    """
+    names : frozenset[str] = frozenset()
+    globs : tuple[str, ...] = ()
+    ids   : frozenset[int] = frozenset()
+
+    def matches(self : Self, id_ : int, name : str) -> bool:
+        return (
+            id_ in self.ids
+            or name in self.names
+            or any(fnmatchcase(name, pattern) for pattern in self.globs)
+        )
+
 @dataclass(kw_only = True)
 class BuildInfo:
     """
@@ -1,25 +1,37 @@
 # TODO: Documentation
 
+import asyncio
+import heapq
+import json
 import os
+from collections import deque
+from concurrent.futures import Future, ProcessPoolExecutor, ThreadPoolExecutor
 from pathlib import Path
 import shutil
 import subprocess
+import tempfile
 import yaml
 import re
 
-from typing import Callable, assert_never
+from typing import Callable, Iterable, assert_never
 
 from config import (
 	MGSSCRIPTTOOLS_PATH,
 	UNGELIFY_PATH,
 	BANK_PATH,
 )
+from lib.cri.cpk._common import BODY_OFFSET
 from lib.cri.cpk.writer import (
 	Config as CpkConfig,
 	Writer as CpkWriter,
 )
-from lib.cri.cpk.reader import Reader as CpkReader
-from lib.types import BuildInfo, ArchiveFormat, ScriptFormat, StringUnitEncoding
+from lib.cri.cpk.reader import (
+	Entry as CpkEntry,
+	Range as CpkRange,
+	Reader as CpkReader,
+)
+from lib.cri.crilayla import decode_buffer as decode_crilayla
+from lib.types import BuildInfo, ArchiveFormat, EntryFilter, Language, ScriptFormat, StringUnitEncoding
 
 def clean_tree(path: str) -> None:
 	if os.path.exists(path):
@@ -82,20 +94,108 @@ def load_mst(path: Path, line_inc: int = 100, comments : list[str] = [], disable
 def load_yaml(path: Path):
 	return yaml.safe_load(load_text(path))
 
-def pack_cpk(cpk_path: Path, src_dir: Path, entries: dict[int, str]) -> None:
-	with open(cpk_path, "wb") as cpk_fp:
-		writer = CpkWriter(
-			cpk_fp,
-			CpkConfig(
-				alignment=2048,
-				encrypt_tables=False,
-				randomize_padding=False,
-			),
-		)
-		for index, name in entries.items():
-			with open(src_dir / name, "rb") as file_fp:
-				writer.write_file(index, name, file_fp.read())
-		writer.close()
+def _cpk_config() -> CpkConfig:
+	return CpkConfig(
+		alignment=2048,
+		encrypt_tables=False,
+		randomize_padding=False,
+		compress=True,
+		compression_threshold=0x800,
+		workers=os.cpu_count() or 1,
+		deduplicate=True,
+	)
+
+def pack_cpk(cpk_path: Path, src_dir: Path, entries: dict[int, str], state_path: Path | None = None, digest_file: Callable[[Path], str] | None = None) -> None:
+	# With `state_path`, the digests of the packed files are recorded there for `update_cpk`.
+	if state_path is not None:
+		assert digest_file is not None, "recording the archive state needs a digest function"
+		state_path.unlink(missing_ok=True)
+	try:
+		with open(cpk_path, "wb") as cpk_fp, CpkWriter(cpk_fp, _cpk_config()) as writer:
+			for index, name in entries.items():
+				writer.write_file(index, name, src_dir / name)
+	except BaseException:
+		# Without its tables, the partial archive is of no use.
+		cpk_path.unlink(missing_ok=True)
+		raise
+	if writer.deduplicated_size:
+		print(f"{ cpk_path }: { writer.deduplicated_size } bytes deduplicated")
+	if state_path is not None and digest_file is not None:
+		_save_cpk_state(state_path, cpk_path, { index: digest_file(src_dir / name) for index, name in entries.items() })
+
+def update_cpk(cpk_path: Path, src_dir: Path, entries: dict[int, str], state_path: Path, digest_file: Callable[[Path], str]) -> None:
+	# Appends only the entries whose contents changed since the archive was written,
+	# every other entry's bytes stay where they are. Entries are compared by the digests of their
+	# files, as recorded in `state_path` when the archive was last written; that record is only
+	# trusted while the archive's size and modification time still match it, so an archive left
+	# behind by an interrupted update (or changed by anything else) is packed again from scratch.
+	recorded = _load_cpk_state(state_path, cpk_path)
+	if recorded is None:
+		pack_cpk(cpk_path, src_dir, entries, state_path, digest_file)
+		return
+
+	config = _cpk_config()
+	digests = { index: digest_file(src_dir / name) for index, name in entries.items() }
+	with open(cpk_path, "rb") as base_fp:
+		try:
+			reader = CpkReader(base_fp)
+		except (EOFError, ValueError, NotImplementedError) as err:
+			print(f"Warning: { cpk_path } could not be read ({ err!r }), packing it again")
+			reader = None
+
+		if reader is not None:
+			by_id = { entry.id_: entry for entry in reader.entries }
+
+			live_size = BODY_OFFSET
+			appended_size = 0
+			changed : set[int] = set()
+			for index, name in entries.items():
+				entry = by_id.get(index)
+				if entry is None or recorded.get(index) != digests[index]:
+					changed.add(index)
+					size = (src_dir / name).stat().st_size
+					appended_size += size + -size % config.alignment
+					continue
+				encoded_size = reader.get_range(entry.index).encoded_size
+				live_size += encoded_size + -encoded_size % config.alignment
+
+			if not changed and by_id.keys() == entries.keys(): return
+
+			if cpk_path.stat().st_size + appended_size <= 2 * (live_size + appended_size):
+				state_path.unlink()
+				# On an error, the old tables stay in place and the state is gone, so the
+				# next build packs the archive again.
+				with open(cpk_path, "r+b") as cpk_fp, CpkWriter(cpk_fp, config, base=reader) as writer:
+					for index, name in entries.items():
+						if index in changed:
+							writer.write_file(index, name, src_dir / name)
+						else:
+							writer.keep_file(index, name)
+				if writer.deduplicated_size:
+					print(f"{ cpk_path }: { writer.deduplicated_size } bytes deduplicated")
+				_save_cpk_state(state_path, cpk_path, digests)
+				return
+
+	# Replaced entries take up most of the archive by now (or it is unreadable), start over.
+	pack_cpk(cpk_path, src_dir, entries, state_path, digest_file)
+
+def _load_cpk_state(state_path: Path, cpk_path: Path) -> dict[int, str] | None:
+	try:
+		state = json.loads(load_text(state_path))
+		status = cpk_path.stat()
+		if state["size"] != status.st_size or state["mtime_ns"] != status.st_mtime_ns: return None
+		return { int(index): digest for index, digest in state["entries"].items() }
+	except (OSError, ValueError, KeyError):
+		return None
+
+def _save_cpk_state(state_path: Path, cpk_path: Path, digests: dict[int, str]) -> None:
+	status = cpk_path.stat()
+	state_path.parent.mkdir(parents=True, exist_ok=True)
+	save_text(state_path, json.dumps({
+		"size": status.st_size,
+		"mtime_ns": status.st_mtime_ns,
+		"entries": { str(index): digest for index, digest in digests.items() },
+	}, indent="\t"))
 
 def pack_mpk(mpk_path: Path, src_dir: Path, entries: dict[int, str]):
 	run_command(
@@ -105,17 +205,69 @@ def pack_mpk(mpk_path: Path, src_dir: Path, entries: dict[int, str]):
 		*map(lambda fl: src_dir / fl, entries.values())
 	)
 
-def unpack_cpk(dst_dir: Path, cpk_path: Path, entries: dict[int, str]) -> None:
+def unpack_cpk(dst_dir: Path, cpk_path: Path, entries: dict[int, str], workers: int = 1, entry_filter: EntryFilter | None = None, index_cache: Path | None = None) -> None:
 	dst_dir.mkdir(parents=True, exist_ok=True)
 	with open(cpk_path, "rb") as cpk_fp:
-		reader = CpkReader(cpk_fp)
-		for entry in reader.entries:
-			name = entries[entry.id_]
-			with open(dst_dir / name, "wb") as file_fp:
-				file_fp.write(reader.read_file(entry.index))
+		reader = CpkReader(cpk_fp, use_mmap=True, index_cache=index_cache)
+		try:
+			# Entries left out by the filter are never read, let alone decompressed.
+			selected = reader.entries
+			if entry_filter is not None:
+				selected = [entry for entry in selected if entry_filter.matches(entry.id_, entries[entry.id_])]
+
+			# Submitted in offset order so that reads stay sequential on disk.
+			ordered = sorted(selected, key=lambda entry: reader.get_range(entry.index).offset)
+			if workers > 1:
+				_extract_cpk_entries(reader, [ (entry, dst_dir / entries[entry.id_]) for entry in ordered ], workers)
+			else:
+				for entry in ordered:
+					_save_bytes(dst_dir / entries[entry.id_], reader.read_file(entry.index))
+		finally:
+			reader.close()
 
-def unpack_mpk(dst_dir: Path, mpk_path: Path, entries: dict[int, str]) -> None:
+def _extract_cpk_entries(reader: CpkReader, targets: list[tuple[CpkEntry, Path]], workers: int) -> None:
+	# CRILAYLA decoding is pure Python and holds the GIL, so compressed entries are decoded in a
+	# process pool; threads only copy stored entries out of the mapping and write the files.
+	# Compressed input waiting on the pool is bounded, and results are taken in submission order.
+	max_pending_size = 64 << 20
+	with ProcessPoolExecutor(workers) as decoders, ThreadPoolExecutor(workers) as writers:
+		writes : list[Future[None]] = []
+		pending : deque[tuple[Path, CpkRange, Future[bytes]]] = deque()
+		pending_size = 0
+
+		def write_pending() -> None:
+			nonlocal pending_size
+			path, range_, decoded = pending.popleft()
+			pending_size -= range_.encoded_size
+			data = decoded.result()
+			if len(data) != range_.size:
+				raise ValueError("size mismatch")
+			writes.append(writers.submit(_save_bytes, path, data))
+
+		for entry, path in targets:
+			range_ = reader.get_range(entry.index)
+			if range_.encoded_size == range_.size:
+				writes.append(writers.submit(_save_bytes, path, reader.read_encoded_file(entry.index)))
+				continue
+			pending.append((path, range_, decoders.submit(decode_crilayla, bytes(reader.read_encoded_file(entry.index)))))
+			pending_size += range_.encoded_size
+			while pending_size > max_pending_size:
+				write_pending()
+
+		while pending:
+			write_pending()
+		for write in writes:
+			write.result()
+
+def _save_bytes(path: Path, data: bytes | memoryview) -> None:
+	with open(path, "wb") as file_fp:
+		file_fp.write(data)
+
+def unpack_mpk(dst_dir: Path, mpk_path: Path, entries: dict[int, str], entry_filter: EntryFilter | None = None) -> None:
 	dst_dir.mkdir(parents=True, exist_ok=True)
+	if entry_filter is not None:
+		entries = { id_: name for id_, name in entries.items() if entry_filter.matches(id_, name) }
+		if not entries: return
 	run_command(
 		UNGELIFY_PATH,
 		"extract",
@@ -124,69 +276,199 @@ def unpack_mpk(dst_dir: Path, mpk_path: Path, entries: dict[int, str]) -> None:
 		*entries.values()
 	)
 
-def compile_scripts(dst_dir: Path, src_dir: Path, flag_set: str, charset: str, string_unit_encoding: StringUnitEncoding) -> None:
-	run_command(
-		MGSSCRIPTTOOLS_PATH,
-		"--mode", "Compile",
-		"--bank-directory", BANK_PATH,
-		"--flag-set", flag_set,
-		"--charset", charset,
-		"--uncompiled-directory", src_dir,
-		"--compiled-directory", dst_dir,
-		"--string-unit-encoding", string_unit_encoding
-	)
+def compile_scripts(dst_dir: Path, src_dir: Path, flag_set: str, charset: str, string_unit_encoding: StringUnitEncoding, workers: int = 1) -> None:
+	_run_script_tool("Compile", src_dir, dst_dir, lambda src, dst: _script_tool_args("Compile", src, dst, flag_set, charset, string_unit_encoding), workers)
 
-def decompile_scripts(dst_dir: Path, src_dir: Path, flag_set: str, charset: str, string_unit_encoding: StringUnitEncoding) -> None:
-	run_command(
+def compile_changed_scripts(dst_dir: Path, src_dir: Path, state_path: Path, context: str, digest_file: Callable[[Path], str], flag_set: str, charset: str, string_unit_encoding: StringUnitEncoding, workers: int = 1) -> None:
+	# Only scripts whose sources differ from the last compiled state are staged into a
+	# temporary uncompiled directory; everything else already compiled in `dst_dir` is kept.
+	# A script's sources (`.scs`/`.sct`, or a single `.mst`) are staged together. Any change
+	# in `context` (tool or settings), or a removed source, falls back to a full compile.
+	# Sources are hashed with `digest_file`, i.e. the build manifest's cached digests.
+	sources = { path.relative_to(src_dir).as_posix(): digest_file(path) for path in sorted(src_dir.rglob("*")) if path.is_file() }
+
+	previous : dict[str, str] = {}
+	if dst_dir.exists() and state_path.exists():
+		state = json.loads(load_text(state_path))
+		if state["context"] == context and state["sources"].keys() <= sources.keys():
+			previous = state["sources"]
+
+	if not previous: clean_tree(str(dst_dir))
+	groups = _group_script_files(sources)
+	changed = [ name for group in groups.values() if any(sources[name] != previous.get(name) for name in group) for name in group ]
+
+	if changed:
+		state_path.unlink(missing_ok=True)
+		staging_root = state_path.parent
+		staging_root.mkdir(parents=True, exist_ok=True)
+		with tempfile.TemporaryDirectory(prefix="compile-", dir=staging_root) as staging_dir:
+			staging_src = Path(staging_dir) / "src"
+			staging_dst = Path(staging_dir) / "dst"
+			_stage_files(src_dir, staging_src, changed)
+			staging_dst.mkdir()
+			print(f"Compiling { len(changed) } of { len(sources) } script files")
+			compile_scripts(staging_dst, staging_src, flag_set, charset, string_unit_encoding, workers)
+			_merge_tree(staging_dst, dst_dir)
+
+	save_text(state_path, json.dumps({ "context": context, "sources": sources }, indent="\t"))
+
+def decompile_scripts(dst_dir: Path, src_dir: Path, flag_set: str, charset: str, string_unit_encoding: StringUnitEncoding, workers: int = 1) -> None:
+	_run_script_tool("Decompile", src_dir, dst_dir, lambda src, dst: _script_tool_args("Decompile", dst, src, flag_set, charset, string_unit_encoding), workers)
+
+def _script_tool_args(mode: str, uncompiled_dir: Path, compiled_dir: Path, flag_set: str, charset: str, string_unit_encoding: StringUnitEncoding) -> list[str | Path]:
+	return [
 		MGSSCRIPTTOOLS_PATH,
-		"--mode", "Decompile",
+		"--mode", mode,
 		"--bank-directory", BANK_PATH,
 		"--flag-set", flag_set,
 		"--charset", charset,
-		"--uncompiled-directory", dst_dir,
-		"--compiled-directory", src_dir,
+		"--uncompiled-directory", uncompiled_dir,
+		"--compiled-directory", compiled_dir,
 		"--string-unit-encoding", string_unit_encoding
-	)
+	]
+
+def _run_script_tool(mode: str, src_dir: Path, dst_dir: Path, get_args: Callable[[Path, Path], list[str | Path]], workers: int) -> None:
+	# With several workers, the input files are split into shards of about the same total size,
+	# each staged into its own directory and processed by its own MagesScriptTool process,
+	# after which the outputs are merged into `dst_dir`.
+	files = { path.relative_to(src_dir).as_posix(): path.stat().st_size for path in src_dir.rglob("*") if path.is_file() }
+	shards = _balance_shards(_group_script_files(files), files, workers)
+	if len(shards) <= 1:
+		run_command(*get_args(src_dir, dst_dir))
+		return
+
+	dst_dir.mkdir(parents=True, exist_ok=True)
+	with tempfile.TemporaryDirectory(prefix=f"{ mode.lower() }-", dir=dst_dir.parent) as staging_dir:
+		shard_dirs = [ (Path(staging_dir) / f"{ index }" / "src", Path(staging_dir) / f"{ index }" / "dst") for index in range(len(shards)) ]
+		for shard, (shard_src, shard_dst) in zip(shards, shard_dirs):
+			_stage_files(src_dir, shard_src, shard)
+			shard_dst.mkdir(parents=True)
+
+		results = asyncio.run(run_commands([ get_args(shard_src, shard_dst) for shard_src, shard_dst in shard_dirs ], workers))
+
+		# Output is printed in shard order, as a single run would have streamed it (warnings included).
+		failures = 0
+		for index, (shard, (returncode, output)) in enumerate(zip(shards, results)):
+			if returncode != 0:
+				failures += 1
+				print(f"[ERROR]\tMagesScriptTool ({ mode }) failed on shard { index } ({ len(shard) } files, exit code { returncode }): { ', '.join(shard) }")
+			print(output.decode("utf-8", errors="replace"), end="")
+		if failures:
+			raise Exception(f"MagesScriptTool ({ mode }) failed on { failures } of { len(shards) } shards")
+
+		for _, shard_dst in shard_dirs:
+			_merge_tree(shard_dst, dst_dir)
+
+async def run_commands(commands: list[list[str | Path]], workers: int | None = None) -> list[tuple[int, bytes]]:
+	# At most `workers` (by default, the CPU count) processes run at the same time.
+	semaphore = asyncio.Semaphore(workers or os.cpu_count() or 1)
+	async def run(command: list[str | Path]) -> tuple[int, bytes]:
+		async with semaphore:
+			process = await asyncio.create_subprocess_exec(*command, stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.STDOUT)
+			output, _ = await process.communicate()
+		return process.returncode or 0, output
+	return await asyncio.gather(*map(run, commands))
+
+def _group_script_files(names: Iterable[str]) -> dict[str, list[str]]:
+	# Files of the same script (e.g. `.scs` and `.sct`) differ only by extension and are processed together.
+	groups : dict[str, list[str]] = {}
+	for name in names:
+		groups.setdefault(name.rsplit(".", 1)[0], []).append(name)
+	return groups
+
+def _balance_shards(groups: dict[str, list[str]], sizes: dict[str, int], count: int) -> list[list[str]]:
+	# Largest groups first, each into the currently smallest shard.
+	shards : list[tuple[int, int, list[str]]] = [ (0, index, []) for index in range(max(1, min(count, len(groups)))) ]
+	for group in sorted(groups.values(), key=lambda group: sum(sizes[name] for name in group), reverse=True):
+		size, index, shard = heapq.heappop(shards)
+		shard.extend(group)
+		heapq.heappush(shards, (size + sum(sizes[name] for name in group), index, shard))
+	return [ shard for _, _, shard in sorted(shards, key=lambda shard: shard[1]) if shard ]
+
+def _stage_files(src_dir: Path, dst_dir: Path, names: Iterable[str]) -> None:
+	for name in names:
+		(dst_dir / name).parent.mkdir(parents=True, exist_ok=True)
+		try:
+			os.link(src_dir / name, dst_dir / name)
+		except OSError:
+			shutil.copyfile(src_dir / name, dst_dir / name)
+
+def _merge_tree(src_dir: Path, dst_dir: Path) -> None:
+	for path in sorted(src_dir.rglob("*")):
+		if not path.is_file(): continue
+		target = dst_dir / path.relative_to(src_dir)
+		target.parent.mkdir(parents=True, exist_ok=True)
+		os.replace(path, target)
 
 def get_custom_cls_loader(partial : Path) -> Callable[[str], dict[int, str]]:
 	def inner(name: str) -> dict[int, str]:
 		return load_cls(partial / f"{ name }.cls")
 	return inner
 
-def get_archive_unpacker(src_script_dir : Path, custom_cls_loader : Callable[[str], dict[int, str]], build_info : BuildInfo) -> Callable[[Path, str], None]:
+def get_archive_unpacker(src_script_dir : Path, custom_cls_loader : Callable[[str], dict[int, str]], build_info : BuildInfo, entry_filter : EntryFilter | None = None, index_cache : Path | None = None) -> Callable[[Path, str], None]:
+	# `index_cache` is where the decoded TOCs of the source CPKs are kept, to be reused while they are unchanged.
 	def inner(dst_dir: Path, arc_name: str) -> None:
-		if os.path.exists(dst_dir) and not build_info.clean: return
+		# A filtered extraction leaves a marker next to `dst_dir`, so that a later full
+		# extraction does not take the partially populated directory as complete.
+		partial_marker = _partial_marker(dst_dir)
+		if entry_filter is None and os.path.exists(dst_dir) and not partial_marker.exists() and not build_info.clean: return
 
 		archive_path : Path = src_script_dir / f"{ arc_name }{ build_info.archive }"
 		entries = custom_cls_loader(arc_name)
 
 		match build_info.archive:
 			case ArchiveFormat.MPK:
-				unpack_mpk(dst_dir, archive_path, entries)
+				unpack_mpk(dst_dir, archive_path, entries, entry_filter)
 			case ArchiveFormat.CPK:
-				unpack_cpk(dst_dir, archive_path, entries)
-				if build_info.in_fmt != ScriptFormat.MST or arc_name != "script": return
-
-				for lang in build_info.langs:
-					unpack_cpk(dst_dir / f"mes{+lang:02}", src_script_dir / f"mes{+lang:02}.cpk", custom_cls_loader(f"mes{+lang:02}"))
+				workers = os.cpu_count() or 1
+				unpack_cpk(dst_dir, archive_path, entries, workers, entry_filter, index_cache)
+				if build_info.in_fmt == ScriptFormat.MST and arc_name == "script":
+					for lang in build_info.langs:
+						mes_entries = custom_cls_loader(f"mes{+lang:02}")
+						mes_filter = _mes_entry_filter(entry_filter, entries, mes_entries, lang)
+						unpack_cpk(dst_dir / f"mes{+lang:02}", src_script_dir / f"mes{+lang:02}.cpk", mes_entries, workers, mes_filter, index_cache)
 			case None:
 				assert False, "Unreachable"
 			case _:
 				assert_never(build_info.archive)
+
+		if entry_filter is None:
+			partial_marker.unlink(missing_ok=True)
+		else:
+			partial_marker.touch()
 	return inner
 
-def get_archive_repacker(src_script_dir : Path, out_dir : Path, custom_cls_loader : Callable[[str], dict[int, str]], build_info : BuildInfo) -> Callable[[str, Path], None]:
+def is_partially_unpacked(dst_dir : Path) -> bool:
+	return _partial_marker(dst_dir).exists()
+
+def _partial_marker(dst_dir : Path) -> Path:
+	return dst_dir.with_name(f"{ dst_dir.name }.partial")
+
+def _mes_entry_filter(entry_filter : EntryFilter | None, entries : dict[int, str], mes_entries : dict[int, str], lang : Language) -> EntryFilter | None:
+	# IDs and names of the script archive mean different entries in the `mesXX` archives, so the
+	# filter is carried over by script instead: `sch01_005.scx` selects `sch01_005_01.msb` in `mes01`.
+	if entry_filter is None: return None
+	scripts = { name.rsplit(".", 1)[0] for id_, name in entries.items() if entry_filter.matches(id_, name) }
+	return EntryFilter(names = frozenset(
+		name for name in mes_entries.values()
+		if name.rsplit(".", 1)[0].removesuffix(f"_{+lang:02}") in scripts
+	))
+
+def get_archive_repacker(src_script_dir : Path, out_dir : Path, custom_cls_loader : Callable[[str], dict[int, str]], build_info : BuildInfo, state_dir : Path, digest_file : Callable[[Path], str]) -> Callable[[str, Path], None]:
+	# `state_dir` holds what `update_cpk` knows of each output archive, `digest_file` hashes the files packed into them.
 	def inner(arc_name: str, src_dir: Path) -> None:
 		match build_info.archive:
 			case ArchiveFormat.MPK:
 				shutil.copy(src_script_dir / "script.mpk", out_dir / "enscript.mpk")
 				pack_mpk(out_dir / f"enscript.mpk", src_dir, custom_cls_loader(arc_name))
 			case ArchiveFormat.CPK:
-				pack_cpk(out_dir / f"c0{ arc_name }.cpk", src_dir, custom_cls_loader(arc_name))
+				# Unchanged entries are left in place in archives from a previous build.
+				repack_cpk = pack_cpk if build_info.clean else update_cpk
+				repack_cpk(out_dir / f"c0{ arc_name }.cpk", src_dir, custom_cls_loader(arc_name), state_dir / f"c0{ arc_name }.json", digest_file)
 				if build_info.in_fmt != ScriptFormat.MST or arc_name != "script": return
 
 				for lang in build_info.langs :
-					pack_cpk(out_dir / f"mes{+lang:02}.cpk", src_dir / f"mes{+lang:02}", custom_cls_loader(f"mes{+lang:02}"))
+					repack_cpk(out_dir / f"mes{+lang:02}.cpk", src_dir / f"mes{+lang:02}", custom_cls_loader(f"mes{+lang:02}"), state_dir / f"mes{+lang:02}.json", digest_file)
 			case None:
 				assert False, "Unreachable"
 			case _: